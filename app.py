@@ -1,10 +1,31 @@
 import cv2
+import numpy as np
 import os
 import time
 import threading
 import shutil
-from flask import Flask, Response, render_template_string, send_from_directory, request, jsonify
+import re
+import sqlite3
+import queue
+import atexit
+import itertools
+import heapq
+import struct
+import zlib
+import hashlib
+import bisect
+import io
+import json
+import warnings
+import sys
+import asyncio
+import math
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, Response, send_from_directory, request, jsonify
 from datetime import datetime
+from urllib.parse import unquote_to_bytes
 
 app = Flask(__name__)
 
@@ -13,12 +34,113 @@ app = Flask(__name__)
 
 SAVE_DIR = "moon_shots"              # Where photos get saved
 AUTO_CAPTURE_INTERVAL = 10           # Seconds between auto-captures
-STREAM_QUALITY = 70                  # JPEG quality (1-100, lower = faster)
-STREAM_WIDTH = 320                   # Live stream width
-STREAM_HEIGHT = 240                  # Live stream height
+CHANGE_DETECTION = False             # Skip auto-captures that look the same as the last one saved
+CHANGE_THRESHOLD = 3.0               # Mean pixel difference (0-255) that counts as "changed"
+CHANGE_BURST_THRESHOLD = 20.0        # A change this big also grabs a few extra frames
+CHANGE_BURST_FRAMES = 3              # How many extra frames
+CHANGE_BURST_SPACING = 1.0           # Seconds between the extra frames
+STREAM_QUALITY = 70                  # JPEG quality (1-100, lower = faster); the most any viewer gets when adaptive
+STREAM_WIDTH = 320                   # Live stream width (adaptive streaming off)
+STREAM_HEIGHT = 240                  # Live stream height (adaptive streaming off)
+STREAM_MAX_FPS = 30                  # Frame rate cap when adaptive streaming is off
+ADAPTIVE_STREAM = True               # Pick each viewer's stream profile from how fast they keep up
+STREAM_PROFILES = [                  # (width, height, JPEG quality, max FPS), worst to best
+    (160, 120, 50, 5),
+    (320, 240, 60, 10),
+    (320, 240, 70, 20),
+    (640, 480, 75, 25),
+    (960, 720, 80, 30),
+]
+STREAM_START_PROFILE = 2             # New viewers start here and step up/down from it
+STREAM_MAX_LATENCY = 0.5             # Seconds from sensor to sent before a viewer steps down
+ROI_DETECT_EVERY = 5                 # Look for the bright target every N frames (/video?roi=1), smooth in between
+ROI_DETECT_WIDTH = 160               # Width of the shrunk frame the target is searched in
+ROI_THRESHOLD = 60                   # Brightness (0-255) that counts as "target" rather than sky
+ROI_MIN_PIXELS = 4                   # Fewer bright pixels than this (in the shrunk frame) = nothing to track
+ROI_PADDING = 1.6                    # Crop this much wider than the target itself
+ROI_SMOOTHING = 0.3                  # How quickly the stream crop follows the target (0-1)
+ROI_MIN_SIZE = 64                    # Smallest crop saved with captures (pixels)
+ROI_SAVE_CROPS = False               # Also save a full-detail crop of the target (+ coordinates) with every capture
 PHOTO_WIDTH = 1280                   # Full photo width
 PHOTO_HEIGHT = 720                   # Full photo height
 MAX_STORAGE_MB = 500                 # Auto-delete old photos if storage exceeds this
+STORAGE_HIGH_WATERMARK = 1.0         # Start deleting above this fraction of a limit...
+STORAGE_LOW_WATERMARK = 0.9          # ...and keep going until below this fraction (deletes in batches)
+KIND_QUOTA_MB = {"auto": None, "burst": None, "shot": None, "stack": None, "roi": None}  # Per-kind limits (None = only MAX_STORAGE_MB)
+KIND_KEEP_FACTOR = {"shot": 4, "stack": 4, "burst": 2, "auto": 1, "roi": 1, "other": 1}  # shot_ photos live 4x as long as auto_
+MIN_PHOTOS_KEPT = 10                 # Never auto-delete below this many photos
+RECOMPRESS_ENABLED = True            # Shrink old photos step by step before the quota deletes any
+RECOMPRESS_TIERS = [                 # (name, age in days, JPEG quality, max width or None), mildest first
+    ("q75", 3, 75, None),            #   Ages are scaled by KIND_KEEP_FACTOR like deletion is
+    ("q60", 14, 60, None),
+    ("small", 60, 55, 640),
+]
+RECOMPRESS_INTERVAL = 60             # Seconds between background recompression passes
+RECOMPRESS_MAX_LOAD = 0.5            # Only recompress when load per core is below this and the governor is "normal"
+RECOMPRESS_BATCH = 20                # Photos per background pass (and per quota squeeze)
+RECOMPRESS_SQUEEZE_AT = 0.95         # Squeeze old photos to the last tier above this fraction of a limit (deleting starts at the limit)
+TIMELAPSE_ENABLED = False            # Append every auto-capture to a rolling time-lapse video
+TIMELAPSE_DIR = os.path.join(SAVE_DIR, "timelapse")  # Where time-lapse videos go
+TIMELAPSE_FPS = 24                   # Playback frame rate of the videos
+TIMELAPSE_SEGMENT_FRAMES = 360       # Start a new video file after this many frames (1 hour at 10 s)
+TIMELAPSE_MAX_MB = 300               # Oldest time-lapse videos are deleted above this (on top of MAX_STORAGE_MB)
+INDEX_DB = os.path.join(SAVE_DIR, "photo_index.db")  # Photo index (rebuilt from disk if lost)
+THUMB_DIR = os.path.join(SAVE_DIR, "thumbs")       # Small gallery previews
+THUMB_WIDTH = 320                    # Thumbnail width (height keeps the aspect ratio)
+THUMB_QUALITY = 70                   # Thumbnail JPEG quality
+THUMB_MAX_MB = 50                    # Least recently viewed thumbnails are evicted above this
+GALLERY_PAGE_SIZE = 48               # Photos per gallery page / infinite-scroll step
+WRITER_THREADS = 2                   # Threads compressing + saving photos in the background
+WRITER_QUEUE_SIZE = 8                # Photos allowed to wait for the SD card (~2.7 MB each)
+WRITER_FULL_POLICY = "block"         # When the queue is full: "block" (wait a bit) or "drop"
+WRITER_BLOCK_SECONDS = 2.0           # How long "block" waits before giving up on a photo
+BURST_MAX_FRAMES = 30                # Burst frames are held in RAM (~2.7 MB each) before saving
+BURST_ENCODE_THREADS = 3             # Burst frames compressed + saved in parallel
+BURST_MAX_DELAY = 10.0               # Longest gap between burst frames (seconds)
+SHARPNESS_WIDTH = 320                # Burst frames are shrunk to this width before scoring sharpness...
+SHARPNESS_ROI = 0.5                  # ...and only this fraction of it, around the brightest spot, is scored
+PRETRIGGER_ENABLED = False           # Keep the last few seconds in RAM so captures can reach back in time
+PRETRIGGER_SECONDS = 10              # How far back the buffer goes...
+PRETRIGGER_MB = 24                   # ...unless it runs out of memory budget first
+PRETRIGGER_FPS = 10                  # Frames per second kept in the buffer
+PRETRIGGER_QUALITY = 85              # JPEG quality of buffered frames (passthrough JPEGs are kept as-is)
+PRETRIGGER_TIER_FPS = {"warm": 5, "hot": 1, "critical": 0}  # Lower encode rate per governor tier (0 = pause)
+STACK_METHOD = "sigma"               # How /stack combines frames: "mean", "median" or "sigma" (sigma-clipped mean)
+STACK_SIGMA = 2.5                    # Pixels further than this many std devs from the others are thrown out
+STACK_MAX_FRAMES = 100               # Most frames one stack will take
+STACK_CHUNK_FRAMES = 12              # Frames held in RAM at once for median / sigma (~2.7 MB each)
+
+CAMERA_BACKEND = "opencv"            # "opencv" (real camera), "synthetic" (test pattern) or "replay"
+CAMERA_INDEX = 0                     # Which /dev/video* the opencv backend opens
+SYNTHETIC_FPS = 30                   # Frame rate of the synthetic test pattern
+REPLAY_SOURCE = "replay"             # Folder of .jpg files or a video file for the replay backend
+REPLAY_FPS = 10                      # Frame rate the replay backend plays back at
+MJPEG_PASSTHROUGH = False            # Ask the camera for MJPEG and keep its JPEGs as-is (no decode/re-encode)
+CAMERA_FAIL_THRESHOLD = 3            # Failed reads in a row before the camera is reopened
+CAMERA_BACKOFF_START = 0.5           # Seconds before the first reopen attempt...
+CAMERA_BACKOFF_MAX = 30              # ...doubling after every failed attempt, up to this
+CAMERA_WARMUP_FRAMES = 5             # Frames thrown away after (re)opening while exposure settles
+CAMERA_STALE_INTERVAL = 1.0          # During an outage, re-send the last good frame (marked stale) this often
+CAMERA_FAULTS = None                 # Break the camera on purpose for testing, e.g.
+                                     #   {"fail_after": 300, "outage": 50, "open_failures": 2, "repeat": True}
+SAMPLE_INTERVAL = 5                  # Seconds between system stat samples (/system, /system/history)
+SAMPLE_HISTORY = 720                 # Samples kept in memory (720 x 5 s = 1 hour)
+THERMAL_PATH = '/sys/class/thermal/thermal_zone0/temp'  # CPU temperature in millidegrees
+GOVERNOR_ENABLED = True              # Step the stream down when the Pi gets hot or busy
+GOVERNOR_TIERS = [                   # Coolest to hottest: (name, enter at °C, enter at load per core,
+                                     #   best STREAM_PROFILES level, max stream FPS, max JPEG quality, encodes at once)
+    ("normal",   None, None, 4, 30, 80, None),
+    ("warm",     65,   1.0,  3, 20, 70, 2),
+    ("hot",      72,   1.5,  2, 10, 60, 1),
+    ("critical", 78,   2.5,  1,  5, 50, 1),
+]
+GOVERNOR_INTERVAL = 2                # Seconds between governor checks
+GOVERNOR_HYSTERESIS_C = 5            # Must cool this far below a tier's limit before leaving it...
+GOVERNOR_HYSTERESIS_LOAD = 0.3       # ...and get this far below its load limit...
+GOVERNOR_RECOVER_SECONDS = 30        # ...for this long, then step back one tier at a time
+SERVER_MODE = "threaded"             # "threaded" (one thread per connection) or "async" (see ASYNC SERVER)
+ASYNC_WORKER_THREADS = 4             # Threads running encodes and the normal Flask routes in async mode
+PHOTO_CACHE_SECONDS = 3600           # Browsers reuse photos/thumbnails this long, then revalidate with the ETag
 
 # CAMERA SETUP - Thread-safe camera access. (I think)
 # This section sets up the camera for use in the application.
@@ -26,54 +148,2434 @@ MAX_STORAGE_MB = 500                 # Auto-delete old photos if storage exceeds
 # preventing crashes and other issues.
 
 
-camera = None
 camera_lock = threading.Lock()       # Prevents crashes from multiple threads
 
-def get_camera():
-    """Get the camera, opening it if needed."""
-    global camera
-    if camera is None or not camera.isOpened():
-        camera = cv2.VideoCapture(0)
-        camera.set(cv2.CAP_PROP_FRAME_WIDTH, PHOTO_WIDTH)
-        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, PHOTO_HEIGHT)
-    return camera
-
-def read_frame():
-    """Safely read a frame from the camera."""
-    with camera_lock:
-        cam = get_camera()
-        success, frame = cam.read()
-        if not success:
-            # Try reopening the camera if it failed
-            cam.release()
-            cam = get_camera()
-            success, frame = cam.read()
-        return success, frame
+# Camera backends. Anything with cv2.VideoCapture's isOpened / grab /
+# retrieve / read / set / release works, so the rest of the app doesn't
+# care whether frames come from a real sensor or not. The synthetic and
+# replay backends let us measure throughput without a camera attached.
+
+class PacedSource:
+    """Base for fake cameras: grab() waits until the next frame is due, like a real sensor."""
+
+    def __init__(self, fps):
+        self.interval = 1.0 / fps
+        self.next_due = time.perf_counter()
+        self.opened = True
+        self.frame = None
+        self.compressed = False      # CAP_PROP_CONVERT_RGB = 0 -> hand out JPEG bytes like a MJPEG camera
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_CONVERT_RGB:
+            self.compressed = not value
+            return True
+        return False                 # Resolution etc. are fixed when the source is made
+
+    def get(self, prop):
+        return 0
+
+    def _wait_for_next_frame(self):
+        now = time.perf_counter()
+        if now < self.next_due:
+            time.sleep(self.next_due - now)
+        # If we fell behind, don't try to catch up with a rush of frames
+        self.next_due = max(self.next_due + self.interval, time.perf_counter())
+
+    def grab(self):
+        if not self.opened:
+            return False
+        self._wait_for_next_frame()
+        self.frame = self._next_frame()
+        return self.frame is not None
+
+    def retrieve(self):
+        if self.frame is None:
+            return False, None
+        if self.compressed:
+            _, jpeg = cv2.imencode('.jpg', self.frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            return True, jpeg.reshape(1, -1)
+        return True, self.frame
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        self.opened = False
+
+
+class SyntheticCamera(PacedSource):
+    """A moon drifting across a noisy night sky, at any resolution and frame rate."""
+
+    def __init__(self, width, height, fps):
+        super().__init__(fps)
+        self.width = width
+        self.height = height
+        self.count = 0
+        rng = np.random.default_rng(0)
+        self.sky = rng.integers(0, 12, (height, width, 3), dtype=np.uint8)
+        for x, y in rng.integers(0, [width, height], (200, 2)):
+            self.sky[y, x] = 255     # A few stars
+
+    def _next_frame(self):
+        self.count += 1
+        frame = self.sky.copy()
+        radius = max(4, self.height // 8)
+        x = int((self.count * 2) % (self.width + 2 * radius)) - radius
+        y = self.height // 2 + int(self.height / 6 * np.sin(self.count / 50))
+        cv2.circle(frame, (x, y), radius, (220, 220, 210), -1)
+        cv2.putText(frame, f"SYNTHETIC {self.count}", (10, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+        return frame
+
+
+class ReplayCamera(PacedSource):
+    """Plays a folder of .jpg files (in name order) or a video file, looping forever."""
+
+    def __init__(self, source, fps, width=None, height=None):
+        super().__init__(fps)
+        self.source = source
+        self.size = (width, height) if width and height else None
+        self.video = None
+        self.files = None
+        self.position = 0
+        if os.path.isdir(source):
+            self.files = sorted(f for f in os.listdir(source) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+            if not self.files:
+                self.opened = False
+        else:
+            self.video = cv2.VideoCapture(source)
+            self.opened = self.video.isOpened()
+
+    def _next_frame(self):
+        if self.files is not None:
+            frame = cv2.imread(os.path.join(self.source, self.files[self.position % len(self.files)]))
+            self.position += 1
+        else:
+            success, frame = self.video.read()
+            if not success:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)  # Loop back to the start
+                success, frame = self.video.read()
+                if not success:
+                    return None
+        if frame is not None and self.size and (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def release(self):
+        super().release()
+        if self.video is not None:
+            self.video.release()
+
+
+class CameraFaults:
+    """A fault schedule that lasts across reopens (see CAMERA_FAULTS).
+
+    After fail_after good reads the camera "unplugs": the next outage
+    reads fail, then the next open_failures opens fail. hang adds that
+    many seconds to every failed read. With repeat the cycle starts over.
+    """
+
+    def __init__(self, fail_after=None, outage=0, open_failures=0, hang=0.0, repeat=False):
+        self.fail_after = fail_after
+        self.outage = outage
+        self.open_failures = open_failures
+        self.hang = hang
+        self.repeat = repeat
+        self.lock = threading.Lock()
+        self.good_reads = 0
+        self.failing_reads = 0       # Failed reads left in the current outage
+        self.failing_opens = 0       # Failed opens left
+        self.injected = 0
+
+    def read_fails(self):
+        with self.lock:
+            if self.failing_reads == 0 and self.fail_after is not None and self.good_reads >= self.fail_after:
+                self.failing_reads = self.outage
+                self.failing_opens = self.open_failures
+                self.good_reads = 0
+                if not self.repeat:
+                    self.fail_after = None
+            if self.failing_reads > 0:
+                self.failing_reads -= 1
+                self.injected += 1
+                fail = True
+            else:
+                self.good_reads += 1
+                fail = False
+        if fail and self.hang:
+            time.sleep(self.hang)
+        return fail
+
+    def open_fails(self):
+        with self.lock:
+            if self.failing_opens > 0:
+                self.failing_opens -= 1
+                self.injected += 1
+                return True
+            return False
+
+
+class FaultyCamera:
+    """Wraps any camera backend and fails reads/opens when CameraFaults says so."""
+
+    def __init__(self, cam, faults):
+        self.cam = cam
+        self.faults = faults
+        self.opened = cam.isOpened() and not faults.open_fails()
+
+    def isOpened(self):
+        return self.opened and self.cam.isOpened()
+
+    def grab(self):
+        if not self.opened or self.faults.read_fails():
+            return False
+        return self.cam.grab()
+
+    def retrieve(self):
+        return self.cam.retrieve()
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def set(self, prop, value):
+        return self.cam.set(prop, value)
+
+    def get(self, prop):
+        return self.cam.get(prop)
+
+    def release(self):
+        self.opened = False
+        self.cam.release()
+
+
+camera_faults = None                 # The CameraFaults made from CAMERA_FAULTS (kept across reopens)
+
+def open_camera():
+    """Open whichever camera backend CAMERA_BACKEND picks."""
+    global camera_faults
+    if CAMERA_BACKEND == "synthetic":
+        cam = SyntheticCamera(PHOTO_WIDTH, PHOTO_HEIGHT, SYNTHETIC_FPS)
+    elif CAMERA_BACKEND == "replay":
+        cam = ReplayCamera(REPLAY_SOURCE, REPLAY_FPS, PHOTO_WIDTH, PHOTO_HEIGHT)
+    elif CAMERA_BACKEND == "opencv":
+        cam = cv2.VideoCapture(CAMERA_INDEX)
+        if MJPEG_PASSTHROUGH:
+            # FOURCC has to be set before the resolution on most UVC cameras
+            cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        cam.set(cv2.CAP_PROP_FRAME_WIDTH, PHOTO_WIDTH)
+        cam.set(cv2.CAP_PROP_FRAME_HEIGHT, PHOTO_HEIGHT)
+    else:
+        raise ValueError(f"Unknown CAMERA_BACKEND {CAMERA_BACKEND!r}")
+    if MJPEG_PASSTHROUGH:
+        # Hand us the camera's JPEG bytes instead of decoding them to BGR
+        cam.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    if CAMERA_FAULTS:
+        if camera_faults is None:
+            camera_faults = CameraFaults(**CAMERA_FAULTS)
+        cam = FaultyCamera(cam, camera_faults)
+    return cam
+
+
+# ============================================================
+# FRAMES - Pixels, JPEG bytes, or both
+# ============================================================
+# With MJPEG_PASSTHROUGH the camera gives us JPEG bytes. Those go
+# straight to disk for captures, and are only decoded when something
+# actually needs pixels (resizing, change detection, stacking...). JPEG
+# can also be decoded at 1/2, 1/4 or 1/8 size for much less work than a
+# full decode, which is all the stream and thumbnails need.
+
+class Frame:
+    """One camera frame: JPEG bytes and/or BGR pixels, decoded lazily and only once."""
+
+    def __init__(self, pixels=None, jpeg=None, stale=False):
+        self.jpeg = jpeg             # bytes straight from the camera (passthrough), or None
+        self.stale = stale           # An old frame re-sent while the camera is down (never saved)
+        self._pixels = pixels
+        self._reduced = {}           # scale factor -> smaller decode
+        self._size = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_camera(cls, data):
+        """Wrap whatever retrieve() gave us. A flat uint8 buffer starting FF D8 is a JPEG."""
+        if data.dtype == np.uint8 and (data.ndim == 1 or data.shape[0] == 1) and data.size > 2:
+            flat = data.reshape(-1)
+            if flat[0] == 0xFF and flat[1] == 0xD8:
+                return cls(jpeg=flat.tobytes())
+        return cls(pixels=data)
+
+    @property
+    def pixels(self):
+        """Full-size BGR image (decoded the first time someone asks)."""
+        if self._pixels is None:
+            with self.lock:
+                if self._pixels is None:
+                    self._pixels = cv2.imdecode(np.frombuffer(self.jpeg, np.uint8), cv2.IMREAD_COLOR)
+        return self._pixels
+
+    @property
+    def size(self):
+        """(width, height) without decoding anything."""
+        if self._size is None:
+            if self._pixels is not None or self.jpeg is None:
+                self._size = (self.pixels.shape[1], self.pixels.shape[0])
+            else:
+                self._size = _jpeg_dimensions(io.BytesIO(self.jpeg))
+        return self._size
+
+    def reduced(self, min_width):
+        """Pixels at least min_width wide, decoding the JPEG at 1/2, 1/4 or 1/8 size if that's enough."""
+        if self.jpeg is None or self._pixels is not None:
+            return self.pixels
+        width = self.size[0] or 0
+        for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                             (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if width // factor >= min_width:
+                with self.lock:
+                    if factor not in self._reduced:
+                        self._reduced[factor] = cv2.imdecode(np.frombuffer(self.jpeg, np.uint8), flag)
+                    return self._reduced[factor]
+        return self.pixels
+
+
+def as_pixels(frame):
+    """BGR pixels from either a Frame or a plain image."""
+    return frame.pixels if isinstance(frame, Frame) else frame
+
 
 # Create the save folder if it doesn't exist
 if not os.path.exists(SAVE_DIR):
     os.makedirs(SAVE_DIR)
 
-def gen_frames():
+# Half-written photos from a crash or power cut (see DiskWriter.save)
+for leftover in os.listdir(SAVE_DIR):
+    if leftover.endswith('.tmp'):
+        os.remove(os.path.join(SAVE_DIR, leftover))
+
+
+# ============================================================
+# METRICS - Where does the time go? (Prometheus text format at /metrics)
+# ============================================================
+# Counters and histograms are just a few numbers behind a lock, so
+# recording costs about the same as an addition. All the formatting
+# happens when /metrics is scraped, so nothing extra runs if nobody asks.
+
+class Counter:
+    """A number that only goes up."""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter",
+                f"{self.name} {self.value}"]
+
+
+class Histogram:
+    """Counts observations into buckets (for latencies and sizes)."""
+
+    SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help_text, buckets=SECONDS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A value worked out only when /metrics is scraped.
+
+    fn returns a number, or a list of (labels dict, number) pairs. Use
+    kind="counter" for totals that some other object already keeps.
+    """
+
+    def __init__(self, name, help_text, fn, kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.fn()
+        if isinstance(value, list):
+            for labels, v in value:
+                label_text = ",".join(f'{k}="{str(val).replace(chr(34), "")}"' for k, val in labels.items())
+                lines.append(f"{self.name}{{{label_text}}} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Metrics:
+    """Everything /metrics reports, in the order it was registered."""
+
+    def __init__(self):
+        self.items = []
+
+    def counter(self, name, help_text):
+        self.items.append(Counter(name, help_text))
+        return self.items[-1]
+
+    def histogram(self, name, help_text, buckets=Histogram.SECONDS):
+        self.items.append(Histogram(name, help_text, buckets))
+        return self.items[-1]
+
+    def gauge(self, name, help_text, fn, kind="gauge"):
+        self.items.append(Gauge(name, help_text, fn, kind))
+        return self.items[-1]
+
+    def render(self):
+        lines = []
+        for item in self.items:
+            try:
+                lines += item.render()
+            except Exception as e:
+                lines.append(f"# {item.name} failed: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+BYTE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6)
+frame_read_seconds = metrics.histogram("waldo_frame_read_seconds", "Time to grab + retrieve one camera frame")
+frame_read_failures = metrics.counter("waldo_frame_read_failures_total", "Camera reads that failed")
+camera_opens = metrics.counter("waldo_camera_opens_total", "Times the camera was opened (first open + reopens)")
+frame_wait_seconds = metrics.histogram("waldo_frame_wait_seconds", "Time streams, captures and bursts waited for a new frame")
+stream_resize_seconds = metrics.histogram("waldo_stream_resize_seconds", "cv2.resize time for stream frames")
+stream_encode_seconds = metrics.histogram("waldo_stream_encode_seconds", "cv2.imencode time for stream frames")
+stream_bytes_sent = metrics.counter("waldo_stream_bytes_sent_total", "Stream bytes sent to all viewers")
+stream_frames_sent = metrics.counter("waldo_stream_frames_sent_total", "Stream frames sent to all viewers")
+imwrite_seconds = metrics.histogram("waldo_imwrite_seconds", "Encode + write time for saved photos")
+photo_bytes = metrics.histogram("waldo_photo_bytes", "Size of saved photos", BYTE_BUCKETS)
+bytes_written = metrics.counter("waldo_bytes_written_total", "Photo bytes written to the SD card")
+autocapture_drift_seconds = metrics.histogram(
+    "waldo_autocapture_drift_seconds", "How much later than AUTO_CAPTURE_INTERVAL each auto-capture ran")
+
+
+# ============================================================
+# FRAME BROADCASTER - One thread reads the camera, everyone shares
+# ============================================================
+# Only the grabber thread ever calls camera.read(). Each new frame is
+# published with a sequence number, and every consumer (stream clients,
+# /capture, /burst, auto-capture) waits on a condition variable for a
+# sequence number it hasn't seen yet. Camera reads per second now depend
+# on the sensor, not on how many browsers are open.
+# Frames are published as Frame objects (see FRAMES above). Consumers
+# must treat them as read-only (they are shared).
+# The grabber thread is also the camera supervisor. When reads keep
+# failing it releases the camera and reopens it with exponential backoff,
+# throws away the first few frames after every open, and meanwhile keeps
+# re-sending the last good frame marked stale (with a banner), so viewers
+# see what's going on and nobody waits on a dead camera. The backoff only
+# goes back to CAMERA_BACKOFF_START once a reopened camera has got through
+# its warm-up, so one that opens and then fails straight away (a loose
+# cable) keeps backing off up to CAMERA_BACKOFF_MAX instead of thrashing. Stale frames are
+# never saved: read_frame(), bursts, stacking and the pre-trigger buffer
+# skip them. Health and reconnect counts are at /camera.
+
+class FrameBroadcaster:
+    """Owns the camera read loop and hands the newest frame to everyone."""
+
+    def __init__(self, opener=None):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.seq = 0                 # Goes up by one for every frame read
+        self.timestamp = 0.0         # time.time() when the newest frame arrived
+        self.fps = 0.0               # Smoothed camera reads per second
+        self.thread = None
+        self.listeners = []          # Told about every new frame (see AsyncServer)
+        # Camera supervisor
+        self.opener = opener         # Makes a camera (defaults to open_camera; tests can pass a fake)
+        self.camera = None
+        self.state = "starting"      # starting -> warming_up -> healthy -> degraded -> reconnecting -> ...
+        self.state_since = time.time()
+        self.consecutive_failures = 0
+        self.backoff = CAMERA_BACKOFF_START
+        self.warmup_left = 0
+        self.warmup_discarded = 0
+        self.reconnects = 0
+        self.open_failures = 0
+        self.last_good = None        # (Frame, grab time) of the newest real frame
+        self.last_stale = 0.0
+        self.stopping = threading.Event()
+
+    def start(self):
+        """Start the grabber thread (safe to call more than once)."""
+        with self.condition:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the grabber thread and release the camera."""
+        self.stopping.set()
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def publish(self, frame, now=None):
+        """Store a new frame and wake up everyone waiting for one.
+
+        now is when the sensor grabbed the frame (defaults to right now).
+        """
+        if now is None:
+            now = time.time()
+        with self.condition:
+            if self.timestamp and not frame.stale:
+                dt = now - self.timestamp
+                if dt > 0:
+                    self.fps = 0.9 * self.fps + 0.1 * (1.0 / dt)
+            self.frame = frame
+            self.seq += 1
+            self.timestamp = now
+            self.condition.notify_all()
+            seq = self.seq
+        for listener in self.listeners:
+            listener.frame_published(seq)
+
+    def wait_for_frame(self, last_seq=0, timeout=2.0):
+        """Wait for a frame newer than last_seq.
+
+        Returns (seq, frame). On timeout frame is None and seq is unchanged.
+        """
+        seq, frame, _ = self.wait_for_frame_timed(last_seq, timeout)
+        return seq, frame
+
+    def wait_for_frame_timed(self, last_seq=0, timeout=2.0):
+        """Same as wait_for_frame, but also returns when the frame was grabbed."""
+        self.start()
+        waited = time.perf_counter()
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > last_seq, timeout)
+            frame_wait_seconds.observe(time.perf_counter() - waited)
+            if self.seq > last_seq:
+                return self.seq, self.frame, self.timestamp
+            return last_seq, None, None
+
+    def latest_seq(self):
+        with self.condition:
+            return self.seq
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"📷 Camera: {self.state} -> {state}")
+            self.state = state
+            self.state_since = time.time()
+
+    def _open(self):
+        """Try to (re)open the camera. Returns True if it's usable."""
+        camera_opens.inc()
+        try:
+            cam = (self.opener or open_camera)()
+        except Exception as e:
+            print(f"⚠️ Camera open failed: {e}")
+            cam = None
+        if cam is None or not cam.isOpened():
+            if cam is not None:
+                cam.release()
+            self.open_failures += 1
+            return False
+        self.camera = cam
+        self.warmup_left = CAMERA_WARMUP_FRAMES
+        self._set_state("warming_up")
+        return True
+
+    def _read(self):
+        """One grab + retrieve. Returns (Frame or None, grab time)."""
+        with camera_lock:
+            started = time.perf_counter()
+            # grab() latches the sensor frame, retrieve() decodes it.
+            # Timing the grab gives bursts an accurate capture time.
+            frame = None
+            try:
+                if self.camera.grab():
+                    grabbed_at = time.time()
+                    success, data = self.camera.retrieve()
+                    if success and data is not None:
+                        frame = Frame.from_camera(data)
+                else:
+                    grabbed_at = time.time()
+            except cv2.error as e:
+                print(f"⚠️ Camera read failed: {e}")
+                grabbed_at = time.time()
+            frame_read_seconds.observe(time.perf_counter() - started)
+        return frame, grabbed_at
+
+    def _publish_stale(self):
+        """Re-send the last good frame with an "offline" banner, at most every CAMERA_STALE_INTERVAL."""
+        now = time.time()
+        if self.last_good is None or now - self.last_stale < CAMERA_STALE_INTERVAL:
+            return
+        self.last_stale = now
+        good, grabbed_at = self.last_good
+        pixels = good.pixels.copy()
+        label = f"CAMERA OFFLINE - last frame {datetime.fromtimestamp(grabbed_at).strftime('%H:%M:%S')}"
+        cv2.rectangle(pixels, (0, 0), (pixels.shape[1], 40), (0, 0, 0), -1)
+        cv2.putText(pixels, label, (10, 28), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+        self.publish(Frame(pixels=pixels, stale=True), now)
+
+    def _wait(self, seconds):
+        """Sleep through a backoff, still sending stale frames to viewers."""
+        until = time.time() + seconds
+        while True:
+            self._publish_stale()
+            remaining = until - time.time()
+            if remaining <= 0 or self.stopping.wait(min(remaining, CAMERA_STALE_INTERVAL)):
+                return
+
+    def _run(self):
+        try:
+            self._supervise()
+        finally:
+            with camera_lock:
+                if self.camera is not None:
+                    self.camera.release()
+                    self.camera = None
+
+    def _supervise(self):
+        while not self.stopping.is_set():
+            if self.camera is None:
+                if not self._open():
+                    self._set_state("reconnecting")
+                    self._wait(self.backoff)
+                    self.backoff = min(self.backoff * 2, CAMERA_BACKOFF_MAX)
+                    continue
+
+            frame, grabbed_at = self._read()
+            if frame is not None:
+                self.consecutive_failures = 0
+                if self.warmup_left > 0:
+                    self.warmup_left -= 1   # Exposure / white balance still settling
+                    self.warmup_discarded += 1
+                    continue
+                self.backoff = CAMERA_BACKOFF_START  # Opened and warmed up (see above)
+                self._set_state("healthy")
+                self.last_good = (frame, grabbed_at)
+                self.publish(frame, grabbed_at)
+                continue
+
+            frame_read_failures.inc()
+            self.consecutive_failures += 1
+            if self.consecutive_failures < CAMERA_FAIL_THRESHOLD:
+                self._set_state("degraded")
+                self._publish_stale()
+                time.sleep(0.05)
+                continue
+
+            # Give up on this handle and reopen it after a backoff
+            with camera_lock:
+                self.camera.release()
+                self.camera = None
+            self.reconnects += 1
+            self.consecutive_failures = 0
+            self._set_state("reconnecting")
+            self._wait(self.backoff)
+            self.backoff = min(self.backoff * 2, CAMERA_BACKOFF_MAX)
+
+    def health(self):
+        """Camera state for /camera and /system."""
+        now = time.time()
+        last_good_at = self.last_good[1] if self.last_good else None
+        return {
+            "state": self.state,
+            "state_seconds": round(now - self.state_since, 1),
+            "healthy": self.state == "healthy",
+            "reconnects": self.reconnects,
+            "open_failures": self.open_failures,
+            "consecutive_failures": self.consecutive_failures,
+            "next_backoff": self.backoff,
+            "warmup_discarded": self.warmup_discarded,
+            "last_good_frame_age": round(now - last_good_at, 1) if last_good_at else None,
+            "fps": round(self.fps, 1),
+            "faults_injected": camera_faults.injected if camera_faults is not None else None,
+        }
+
+
+broadcaster = FrameBroadcaster()
+
+def read_frame(timeout=2.0):
+    """Wait for the next fresh (not stale) frame from the camera. Returns (success, Frame)."""
+    deadline = time.time() + timeout
+    seq = broadcaster.latest_seq()
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False, None
+        seq, frame = broadcaster.wait_for_frame(seq, remaining)
+        if frame is None:
+            return False, None
+        if not frame.stale:
+            return True, frame
+
+# ============================================================
+# STREAM ENCODER - Encode each frame once, share it with every viewer
+# ============================================================
+# Every /video client used to resize + imencode the same frame on its own.
+# Now the first client to ask for a (width, height, quality) profile does
+# the work and everyone else on that profile reuses the finished chunk.
+
+class StreamEncoder:
+    """Caches the multipart JPEG chunk of the newest frame per stream profile."""
+
+    MAX_PROFILES = 8                 # Forget old profiles (e.g. after a quality change)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = {}              # (width, height, quality) -> (seq, chunk bytes)
+        self.profile_locks = {}      # One encode at a time per profile
+        self.encodes = 0
+        self.cache_hits = 0
+
+    def _cached(self, profile, seq):
+        """Return the cached (seq, chunk) if it's at least as new as seq."""
+        with self.lock:
+            cached = self.cache.get(profile)
+            if cached is not None and cached[0] >= seq:
+                self.cache_hits += 1
+                return cached
+            return None
+
+    @staticmethod
+    def key(width, height, quality, crop=None):
+        """Cache key of a stream profile (ROI crops are cached separately)."""
+        return (width, height, quality) if crop is None else (width, height, quality, "roi")
+
+    def get_chunk(self, seq, frame, width, height, quality, crop=None):
+        """Get the multipart chunk for this frame at the given profile.
+
+        crop is an (x, y, w, h) box of the full frame to stream instead of
+        the whole thing (see ROI TRACKING).
+        Returns (seq, chunk). seq may be newer than asked for if another
+        client already encoded a later frame for this profile.
+        """
+        profile = self.key(width, height, quality, crop)
+        cached = self._cached(profile, seq)
+        if cached is not None:
+            return cached
+
+        with self.lock:
+            profile_lock = self.profile_locks.setdefault(profile, threading.Lock())
+
+        with profile_lock:
+            # Someone else may have encoded it while we waited for the lock
+            cached = self._cached(profile, seq)
+            if cached is not None:
+                return cached
+
+            if (crop is None and isinstance(frame, Frame) and frame.jpeg is not None
+                    and frame.size == (width, height)):
+                # Passthrough: the camera's JPEG is already the right size
+                jpeg = frame.jpeg
+            else:
+                with governor.encode_slot():
+                    # Resize for smooth streaming over slow connections
+                    started = time.perf_counter()
+                    if crop is not None:
+                        source = roi_crop_pixels(frame, crop, width)
+                    else:
+                        source = frame.reduced(width) if isinstance(frame, Frame) else frame
+                    small_frame = cv2.resize(source, (width, height))
+                    resized = time.perf_counter()
+
+                    # Encode as JPEG with adjustable quality
+                    encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+                    _, buffer = cv2.imencode('.jpg', small_frame, encode_params)
+                    jpeg = buffer.tobytes()
+                stream_resize_seconds.observe(resized - started)
+                stream_encode_seconds.observe(time.perf_counter() - resized)
+
+            chunk = (b'--frame\r\n'
+                     b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+
+            with self.lock:
+                self.encodes += 1
+                self.cache[profile] = (seq, chunk)
+                if len(self.cache) > self.MAX_PROFILES:
+                    stalest = min(self.cache, key=lambda p: self.cache[p][0])
+                    del self.cache[stalest]
+                    self.profile_locks.pop(stalest, None)
+            return seq, chunk
+
+    def stats(self):
+        with self.lock:
+            served = self.encodes + self.cache_hits
+            return {
+                "encodes": self.encodes,
+                "cache_hits": self.cache_hits,
+                "hit_rate": round(self.cache_hits / served, 3) if served else 0.0,
+                "profiles": [list(p) for p in self.cache],
+            }
+
+
+stream_encoder = StreamEncoder()
+
+# ============================================================
+# ROI TRACKING - Follow the moon instead of streaming black sky
+# ============================================================
+# The moon covers a small part of the frame, so most of the stream's
+# bytes (and most of each photo) are dark sky. Every ROI_DETECT_EVERY
+# frames the tracker thresholds a ROI_DETECT_WIDTH-wide copy of the frame
+# and takes the centroid and spread of the bright pixels (image moments).
+# The crop box eases toward each new detection, so the view doesn't jump.
+# /video?roi=1 then streams that crop at the viewer's usual size and
+# quality: same bytes, far more detail. With ROI_SAVE_CROPS (or
+# "roi": true on /capture) a full-resolution crop is saved next to the
+# photo, with its coordinates in both photos' metadata. Crops are their
+# own "roi" kind, so time-lapses, bursts and kind filters leave them out.
+
+def frame_size(frame):
+    """(width, height) of a Frame or a plain image."""
+    return frame.size if isinstance(frame, Frame) else (frame.shape[1], frame.shape[0])
+
+
+def roi_crop_pixels(frame, crop, min_width=0):
+    """Pixels inside crop (x, y, w, h), using a reduced JPEG decode when that's still sharp enough."""
+    x, y, w, h = crop
+    full_width = frame_size(frame)[0]
+    if isinstance(frame, Frame):
+        # The crop has to stay at least min_width wide after any reduction
+        source = frame.reduced(-(-min_width * full_width // max(w, 1)))
+    else:
+        source = frame
+    scale = source.shape[1] / full_width
+    return source[int(y * scale):int((y + h) * scale), int(x * scale):int((x + w) * scale)]
+
+
+class RoiTracker:
+    """Finds the bright target and keeps a smoothed box around it for the stream."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.target = None           # Latest detection (cx, cy, half width, half height), full-frame pixels
+        self.box = None              # Smoothed version of target that the stream follows
+        self.seq = 0                 # Frame the box was last updated for
+        self.detected_seq = -ROI_DETECT_EVERY
+        self.detections = 0
+        self.misses = 0
+
+    def detect(self, frame):
+        """Look for the target in one frame. Returns (cx, cy, half width, half height) or None."""
+        full_width = frame_size(frame)[0]
+        pixels = frame.reduced(ROI_DETECT_WIDTH) if isinstance(frame, Frame) else frame
+        gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY) if pixels.ndim == 3 else pixels
+        if gray.shape[1] > ROI_DETECT_WIDTH:
+            height = max(1, round(gray.shape[0] * ROI_DETECT_WIDTH / gray.shape[1]))
+            gray = cv2.resize(gray, (ROI_DETECT_WIDTH, height), interpolation=cv2.INTER_AREA)
+        scale = full_width / gray.shape[1]
+        _, mask = cv2.threshold(gray, ROI_THRESHOLD, 255, cv2.THRESH_BINARY)
+        moments = cv2.moments(mask, binaryImage=True)
+        if moments["m00"] < ROI_MIN_PIXELS:
+            return None
+        cx, cy = moments["m10"] / moments["m00"], moments["m01"] / moments["m00"]
+        # For a filled disc the radius is twice the standard deviation along each axis
+        half_w = 2 * (moments["mu20"] / moments["m00"]) ** 0.5 + 1
+        half_h = 2 * (moments["mu02"] / moments["m00"]) ** 0.5 + 1
+        return cx * scale, cy * scale, half_w * scale, half_h * scale
+
+    def update(self, seq, frame):
+        """Smoothed target box for frame number seq (None if there's nothing to track)."""
+        with self.lock:
+            if seq <= self.seq:
+                return self.box  # Another viewer already did this frame
+            due = seq - self.detected_seq >= ROI_DETECT_EVERY
+            if due:
+                self.detected_seq = seq  # Only one viewer runs the detection
+        if due:
+            target = self.detect(frame)
+            with self.lock:
+                self.target = target
+                if target is None:
+                    self.misses += 1
+                else:
+                    self.detections += 1
+        with self.lock:
+            if seq > self.seq:
+                self.seq = seq
+                if self.target is None:
+                    self.box = None
+                elif self.box is None:
+                    self.box = self.target
+                else:
+                    self.box = tuple(b + ROI_SMOOTHING * (t - b) for b, t in zip(self.box, self.target))
+            return self.box
+
+    @staticmethod
+    def crop(box, size, aspect, min_width):
+        """Integer (x, y, w, h) around box with the given aspect ratio, inside a frame of size."""
+        frame_w, frame_h = size
+        cx, cy, half_w, half_h = box
+        w = max(2 * half_w * ROI_PADDING, 2 * half_h * ROI_PADDING * aspect, min_width)
+        h = w / aspect
+        if w > frame_w:
+            w, h = frame_w, frame_w / aspect
+        if h > frame_h:
+            w, h = frame_h * aspect, frame_h
+        w, h = int(round(w)), int(round(h))
+        x = int(min(max(cx - w / 2, 0), frame_w - w))
+        y = int(min(max(cy - h / 2, 0), frame_h - h))
+        return x, y, w, h
+
+    def stream_crop(self, seq, frame, width, height):
+        """Crop box for a viewer streaming at width x height, or None for the whole frame."""
+        box = self.update(seq, frame)
+        if box is None:
+            return None
+        return self.crop(box, frame_size(frame), width / height, width)
+
+    def locate(self, frame):
+        """Fresh (unsmoothed) crop box for saving a photo, or None."""
+        box = self.detect(frame)
+        if box is None:
+            return None
+        size = frame_size(frame)
+        return self.crop(box, size, size[0] / size[1], ROI_MIN_SIZE)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "box": [round(v, 1) for v in self.box] if self.box else None,
+                "target": [round(v, 1) for v in self.target] if self.target else None,
+                "detections": self.detections,
+                "misses": self.misses,
+                "detect_every": ROI_DETECT_EVERY,
+            }
+
+
+roi_tracker = RoiTracker()
+
+
+def submit_with_roi(frame, filename, on_done=None, roi=None, timestamp=None):
+    """Queue a photo, plus a crop of the tracked target if roi (default ROI_SAVE_CROPS).
+
+    Returns (job id, roi info dict or None).
+    """
+    roi = ROI_SAVE_CROPS if roi is None else roi
+    rect = roi_tracker.locate(frame) if roi else None
+    if rect is not None and rect[2] >= frame_size(frame)[0] and rect[3] >= frame_size(frame)[1]:
+        rect = None  # The crop would just be a copy of the photo
+    if rect is None:
+        return disk_writer.submit(frame, filename, on_done=on_done, timestamp=timestamp), None
+    crop_name = filename.rsplit('.', 1)[0] + "_roi.jpg"
+    job_id = disk_writer.submit(frame, filename, on_done=on_done, timestamp=timestamp,
+                                meta={"roi": list(rect), "roi_file": crop_name})
+    if job_id is None:
+        return None, None
+    x, y, w, h = rect
+    crop = np.ascontiguousarray(as_pixels(frame)[y:y + h, x:x + w])
+    crop_job = disk_writer.submit(crop, crop_name, meta={"roi": list(rect), "source": filename},
+                                  timestamp=timestamp)
+    return job_id, {"filename": crop_name, "job_id": crop_job, "box": list(rect)}
+
+
+# ============================================================
+# ADAPTIVE STREAMING - Each viewer gets what their link can carry
+# ============================================================
+# We time how long each multipart chunk takes to drain into a viewer's
+# socket and how old the frame is by the time it's gone. Slow viewers
+# step down through STREAM_PROFILES (smaller, lower quality, fewer FPS),
+# fast ones step back up. A viewer always gets the newest frame when it's
+# ready for one, so frames it couldn't keep up with are skipped, never
+# queued, and its latency stays bounded.
+
+class StreamClient:
+    """Per-viewer stream state and stats."""
+
+    STEP_DOWN_AFTER = 3              # Slow frames in a row before stepping down
+    STEP_UP_AFTER = 5.0              # Seconds of comfortably fast frames before stepping up
+    COOLDOWN = 2.0                   # Seconds to wait after any profile change
+
+    def __init__(self, client_id, remote_addr, profile=None, roi=False):
+        self.id = client_id
+        self.remote_addr = remote_addr
+        self.roi = roi               # Stream a crop around the tracked target
+        self.pinned = profile is not None
+        self.level = profile if profile is not None else STREAM_START_PROFILE
+        self.connected_at = time.time()
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.fps = 0.0               # Smoothed frames actually sent per second
+        self.write_time = 0.0        # Smoothed seconds to drain a chunk
+        self.latency = 0.0           # Smoothed sensor-to-sent seconds
+        self.last_sent = None
+        self.slow_frames = 0
+        self.fast_since = None
+        self.last_change = 0.0
+
+    def profile(self):
+        """(width, height, quality, fps) this viewer should get right now."""
+        if not ADAPTIVE_STREAM and not self.pinned:
+            return governor.clamp(STREAM_WIDTH, STREAM_HEIGHT, STREAM_QUALITY, STREAM_MAX_FPS)
+        width, height, quality, fps = STREAM_PROFILES[self.level]
+        # The Settings page quality is a ceiling on top of the profile
+        return governor.clamp(width, height, min(quality, STREAM_QUALITY), fps)
+
+    def record(self, nbytes, write_seconds, latency):
+        """Update stats after a chunk was sent and adapt the profile."""
+        now = time.time()
+        if self.last_sent is not None and now > self.last_sent:
+            self.fps = 0.9 * self.fps + 0.1 * (1.0 / (now - self.last_sent))
+        self.last_sent = now
+        self.frames_sent += 1
+        self.bytes_sent += nbytes
+        stream_frames_sent.inc()
+        stream_bytes_sent.inc(nbytes)
+        self.write_time = 0.8 * self.write_time + 0.2 * write_seconds
+        self.latency = 0.8 * self.latency + 0.2 * latency
+        if ADAPTIVE_STREAM and not self.pinned:
+            self._adapt(now, write_seconds, latency)
+
+    def _adapt(self, now, write_seconds, latency):
+        budget = 1.0 / self.profile()[3]       # Time we have per frame at this FPS
+        slow = write_seconds > 0.9 * budget or latency > STREAM_MAX_LATENCY
+        fast = self.write_time < 0.25 * budget and self.latency < STREAM_MAX_LATENCY / 2
+
+        self.slow_frames = self.slow_frames + 1 if slow else 0
+        if not fast:
+            self.fast_since = None
+        elif self.fast_since is None:
+            self.fast_since = now
+
+        if now - self.last_change < self.COOLDOWN:
+            return
+        if self.slow_frames >= self.STEP_DOWN_AFTER and self.level > 0:
+            self._set_level(self.level - 1, now)
+        elif (self.fast_since is not None and now - self.fast_since >= self.STEP_UP_AFTER
+              and self.level < len(STREAM_PROFILES) - 1):
+            self._set_level(self.level + 1, now)
+
+    def _set_level(self, level, now):
+        self.level = level
+        self.last_change = now
+        self.slow_frames = 0
+        self.fast_since = None
+
+    def stats(self):
+        width, height, quality, fps = self.profile()
+        return {
+            "id": self.id,
+            "remote_addr": self.remote_addr,
+            "profile": {"width": width, "height": height, "quality": quality, "max_fps": fps},
+            "level": self.level,
+            "pinned": self.pinned,
+            "roi": self.roi,
+            "fps": round(self.fps, 1),
+            "frames_sent": self.frames_sent,
+            "bytes_sent": self.bytes_sent,
+            "write_ms": round(self.write_time * 1000, 1),
+            "latency_ms": round(self.latency * 1000, 1),
+            "connected_seconds": round(time.time() - self.connected_at, 1),
+        }
+
+
+stream_clients = {}                  # id -> StreamClient, for everyone watching /video
+stream_clients_lock = threading.Lock()
+stream_client_ids = itertools.count(1)
+
+def gen_frames(client):
     """Generate frames for the live video stream."""
+    with stream_clients_lock:
+        stream_clients[client.id] = client
+    try:
+        last_seq = 0
+        next_due = 0.0
+        while True:
+            width, height, quality, fps = client.profile()
+
+            # Don't send faster than this viewer's profile allows
+            wait = next_due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            # Always the newest frame; anything in between is skipped
+            seq, frame, grabbed_at = broadcaster.wait_for_frame_timed(last_seq)
+            if frame is None:
+                continue  # Camera is down, keep waiting
+
+            crop = roi_tracker.stream_crop(seq, frame, width, height) if client.roi else None
+            last_seq, chunk = stream_encoder.get_chunk(seq, frame, width, height, quality, crop)
+            next_due = time.time() + 1.0 / fps
+
+            # The server writes the chunk before asking for the next one,
+            # so the time spent in yield is how long the socket took to drain
+            sent_at = time.time()
+            yield chunk
+            done_at = time.time()
+            client.record(len(chunk), done_at - sent_at, done_at - grabbed_at)
+    finally:
+        with stream_clients_lock:
+            stream_clients.pop(client.id, None)
+
+# ============================================================
+# PHOTO INDEX - Remember what's on disk so we don't rescan it
+# ============================================================
+# Listing SAVE_DIR and stat-ing every file gets slow once there are tens
+# of thousands of photos on the SD card. The index keeps one row per photo
+# and is updated whenever we save or delete something. At startup it is
+# compared against the folder and fixed up if the two have drifted apart.
+
+TIMESTAMP_PATTERN = re.compile(r'(\d{8}_\d{6})')
+
+def photo_kind(filename):
+    """shot / burst / auto / stack from the filename prefix, or roi for a target crop."""
+    if filename.rsplit('.', 1)[0].endswith('_roi'):
+        return 'roi'
+    prefix = filename.split('_', 1)[0]
+    return prefix if prefix in ('shot', 'burst', 'auto', 'stack') else 'other'
+
+def photo_timestamp(filename, filepath=None):
+    """Capture time from the filename, falling back to the file's mtime."""
+    match = TIMESTAMP_PATTERN.search(filename)
+    if match:
+        try:
+            return datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').timestamp()
+        except ValueError:
+            pass
+    if filepath is not None:
+        return os.path.getmtime(filepath)
+    return time.time()
+
+def jpeg_dimensions(filepath):
+    """Read (width, height) from a JPEG header without decoding the image."""
+    try:
+        with open(filepath, 'rb') as f:
+            return _jpeg_dimensions(f)
+    except OSError:
+        return None, None
+
+def _jpeg_dimensions(f):
+    if f.read(2) != b'\xff\xd8':
+        return None, None
     while True:
-        success, frame = read_frame()
-        if not success:
-            time.sleep(0.1)  # Brief pause before retry
-            continue
-        
-        # Resize for smooth streaming over slow connections
-        small_frame = cv2.resize(frame, (STREAM_WIDTH, STREAM_HEIGHT))
-        
-        # Encode as JPEG with adjustable quality
-        encode_params = [cv2.IMWRITE_JPEG_QUALITY, STREAM_QUALITY]
-        _, buffer = cv2.imencode('.jpg', small_frame, encode_params)
-        
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-        
-        # Small delay to control frame rate and reduce CPU usage
-        time.sleep(0.033)  # ~30 FPS max
+        if f.read(1) != b'\xff':
+            return None, None
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)  # Fill bytes before the marker code
+        if not marker:
+            return None, None
+        code = marker[0]
+        if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+            continue  # Markers without a length field
+        raw = f.read(2)
+        if len(raw) < 2:
+            return None, None  # Truncated file
+        length = int.from_bytes(raw, 'big')
+        if length < 2:
+            return None, None  # Corrupt segment; seeking would loop forever
+        # SOF0..SOF15 hold the size (except DHT, JPG and DAC)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            header = f.read(5)
+            if len(header) < 5:
+                return None, None
+            return int.from_bytes(header[3:5], 'big'), int.from_bytes(header[1:3], 'big')
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+class PhotoIndex:
+    """SQLite table of every photo in SAVE_DIR plus running totals."""
+
+    def __init__(self, db_path, photo_dir):
+        self.photo_dir = photo_dir
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS photos (
+                filename  TEXT PRIMARY KEY,
+                kind      TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                size      INTEGER NOT NULL,
+                width     INTEGER,
+                height    INTEGER,
+                thumb     INTEGER NOT NULL DEFAULT 0,
+                meta      TEXT,
+                tier      INTEGER NOT NULL DEFAULT 0,
+                thumb_used REAL NOT NULL DEFAULT 0
+            )""")
+        # Indexes made by older versions are missing the newer columns
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(photos)")]
+        for name, definition in (("meta", "TEXT"), ("tier", "INTEGER NOT NULL DEFAULT 0"),
+                                 ("thumb_used", "REAL NOT NULL DEFAULT 0")):
+            if name not in columns:
+                self.db.execute(f"ALTER TABLE photos ADD COLUMN {name} {definition}")
+        # ...and filed ROI crops under their parent photo's kind
+        self.db.execute(r"UPDATE photos SET kind = 'roi' WHERE filename LIKE '%\_roi.jpg' ESCAPE '\' AND kind != 'roi'")
+        self.db.execute("CREATE INDEX IF NOT EXISTS photos_by_time ON photos (timestamp, filename)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS photos_by_kind ON photos (kind, timestamp)")
+        self.db.commit()
+        self.count = 0
+        self.total_bytes = 0
+        self.thumb_bytes = 0         # The thumb column holds each thumbnail's size (0 = none)
+        self.listeners = []          # Told about every add/remove (see StorageQuota)
+        self._load_totals()
+
+    def _load_totals(self):
+        with self.lock:
+            count, total, thumbs = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(thumb), 0) FROM photos").fetchone()
+            self.count, self.total_bytes, self.thumb_bytes = count, total, thumbs
+
+    def add(self, filename, width=None, height=None, size=None, timestamp=None, meta=None):
+        """Add (or refresh) a photo that was just written to disk.
+
+        meta is a dict of extra facts about the photo (sharpness score,
+        crop box...), stored as JSON. Refreshing a photo keeps its old meta
+        unless a new one is given.
+        """
+        filepath = os.path.join(self.photo_dir, filename)
+        if size is None:
+            size = os.path.getsize(filepath)
+        if timestamp is None:
+            timestamp = photo_timestamp(filename, filepath)
+        with self.lock:
+            old = self.db.execute("SELECT size, thumb, meta FROM photos WHERE filename = ?",
+                                  (filename,)).fetchone()
+            meta_json = json.dumps(meta) if meta is not None else (old[2] if old is not None else None)
+            self.db.execute(
+                "INSERT OR REPLACE INTO photos (filename, kind, timestamp, size, width, height, meta) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (filename, photo_kind(filename), timestamp, size, width, height, meta_json))
+            self.db.commit()
+            if old is None:
+                self.count += 1
+                self.total_bytes += size
+            else:
+                self.total_bytes += size - old[0]
+                self.thumb_bytes -= old[1]  # The photo changed, so its thumbnail is stale
+        for listener in self.listeners:
+            listener.photo_added(filename, photo_kind(filename), timestamp, size)
+
+    def remove(self, filename):
+        """Forget a photo. Returns its size in bytes (0 if it wasn't indexed)."""
+        with self.lock:
+            row = self.db.execute("SELECT size, thumb FROM photos WHERE filename = ?", (filename,)).fetchone()
+            if row is None:
+                return 0
+            self.db.execute("DELETE FROM photos WHERE filename = ?", (filename,))
+            self.db.commit()
+            self.count -= 1
+            self.total_bytes -= row[0]
+            self.thumb_bytes -= row[1]
+        for listener in self.listeners:
+            listener.photo_removed(filename)
+        return row[0]
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM photos")
+            self.db.commit()
+            self.count = 0
+            self.total_bytes = 0
+            self.thumb_bytes = 0
+        for listener in self.listeners:
+            listener.photos_cleared()
+
+    def set_thumb(self, filename, size):
+        """Record a thumbnail's size in bytes (0 when it was deleted). A new one counts as just used."""
+        with self.lock:
+            row = self.db.execute("SELECT thumb FROM photos WHERE filename = ?", (filename,)).fetchone()
+            if row is None:
+                return False
+            self.db.execute("UPDATE photos SET thumb = ?, thumb_used = ? WHERE filename = ?",
+                            (size, time.time() if size else 0, filename))
+            self.db.commit()
+            self.thumb_bytes += size - row[0]
+            return True
+
+    def missing_thumbs(self, limit=50):
+        """Newest photos that don't have a thumbnail yet."""
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT filename FROM photos WHERE thumb = 0 "
+                "ORDER BY timestamp DESC, filename DESC LIMIT ?", (limit,))]
+
+    def touch_thumbs(self, used):
+        """Record when thumbnails were last served. used is {filename: time}."""
+        with self.lock:
+            self.db.executemany("UPDATE photos SET thumb_used = ? WHERE filename = ? AND thumb > 0",
+                                [(when, filename) for filename, when in used.items()])
+            self.db.commit()
+
+    def stale_thumbs(self, limit=50):
+        """Photos whose thumbnails were served least recently (eviction candidates)."""
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT filename FROM photos WHERE thumb > 0 "
+                "ORDER BY thumb_used ASC, timestamp ASC LIMIT ?", (limit,))]
+
+    def filenames(self, newest_first=True, limit=None):
+        """Photo filenames sorted by capture time."""
+        order = "DESC" if newest_first else "ASC"
+        sql = f"SELECT filename FROM photos ORDER BY timestamp {order}, filename {order}"
+        params = ()
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = (limit,)
+        with self.lock:
+            return [row[0] for row in self.db.execute(sql, params)]
+
+    def with_prefix(self, prefix):
+        """Filenames starting with prefix, from a range scan of the primary key."""
+        if not prefix:
+            return self.filenames(newest_first=False)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT filename FROM photos WHERE filename >= ? AND filename < ?", (prefix, upper))]
+
+    def get(self, filename):
+        """Everything we know about one photo, or None."""
+        with self.lock:
+            cursor = self.db.execute("SELECT * FROM photos WHERE filename = ?", (filename,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            info = dict(zip([c[0] for c in cursor.description], row))
+        info['meta'] = json.loads(info['meta']) if info.get('meta') else None
+        return info
+
+    def page(self, cursor=None, limit=GALLERY_PAGE_SIZE, kind=None, start=None, end=None):
+        """One page of photos, newest first.
+
+        cursor is the next_cursor from the previous page (None for the
+        first page). Paging is keyset-based on (timestamp, filename), so
+        every page costs the same no matter how deep you scroll.
+        Returns (list of photo dicts, next_cursor or None).
+        """
+        where, params = [], []
+        if cursor:
+            timestamp, _, filename = cursor.partition('|')
+            where.append("(timestamp, filename) < (?, ?)")
+            params += [float(timestamp), filename]
+        if kind:
+            where.append("kind = ?")
+            params.append(kind)
+        if start is not None:
+            where.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("timestamp <= ?")
+            params.append(end)
+        sql = "SELECT * FROM photos"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY timestamp DESC, filename DESC LIMIT ?"
+        params.append(limit + 1)  # One extra to know if there's another page
+        with self.lock:
+            cursor_obj = self.db.execute(sql, params)
+            columns = [c[0] for c in cursor_obj.description]
+            rows = [dict(zip(columns, row)) for row in cursor_obj]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['timestamp']!r}|{rows[-1]['filename']}"
+        return rows, next_cursor
+
+    def iter_photos(self, kind=None, start=None, end=None, batch=200):
+        """Yield photo dicts oldest first, fetching batch rows at a time."""
+        after = None
+        while True:
+            where, params = [], []
+            if after is not None:
+                where.append("(timestamp, filename) > (?, ?)")
+                params += list(after)
+            if kind:
+                where.append("kind = ?")
+                params.append(kind)
+            if start is not None:
+                where.append("timestamp >= ?")
+                params.append(start)
+            if end is not None:
+                where.append("timestamp <= ?")
+                params.append(end)
+            sql = "SELECT * FROM photos"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += " ORDER BY timestamp ASC, filename ASC LIMIT ?"
+            params.append(batch)
+            with self.lock:
+                cursor = self.db.execute(sql, params)
+                columns = [c[0] for c in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor]
+            if not rows:
+                return
+            yield from rows
+            after = (rows[-1]['timestamp'], rows[-1]['filename'])
+
+    def update_file(self, filename, size, width, height, tier):
+        """Record that a photo was rewritten in place (see STORAGE TIERS). Keeps its thumbnail."""
+        with self.lock:
+            row = self.db.execute("SELECT size, kind, timestamp FROM photos WHERE filename = ?",
+                                  (filename,)).fetchone()
+            if row is None:
+                return
+            self.db.execute("UPDATE photos SET size = ?, width = ?, height = ?, tier = ? WHERE filename = ?",
+                            (size, width, height, tier, filename))
+            self.db.commit()
+            self.total_bytes += size - row[0]
+        for listener in self.listeners:
+            listener.photo_added(filename, row[1], row[2], size)
+
+    def tier_candidates(self, tier, before, kinds=None, limit=RECOMPRESS_BATCH, weighted=False):
+        """[(filename, tier), ...] below tier, taken before the given time, oldest first.
+
+        weighted sorts by age divided by KIND_KEEP_FACTOR instead, the
+        same order the quota deletes in.
+        """
+        sql = "SELECT filename, tier FROM photos WHERE tier < ? AND timestamp <= ?"
+        params = [tier, before]
+        if kinds is not None:
+            sql += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            params += list(kinds)
+        if weighted:
+            cases = " ".join("WHEN ? THEN ?" for _ in KIND_KEEP_FACTOR)
+            sql += f" ORDER BY (? - timestamp) / (CASE kind {cases} ELSE 1 END) DESC LIMIT ?"
+            params.append(time.time())
+            for kind, factor in KIND_KEEP_FACTOR.items():
+                params += [kind, float(factor)]
+        else:
+            sql += " ORDER BY timestamp ASC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def tier_totals(self):
+        """{tier: (photo count, bytes)}"""
+        with self.lock:
+            rows = self.db.execute("SELECT tier, COUNT(*), SUM(size) FROM photos GROUP BY tier").fetchall()
+        return {tier: (count, size) for tier, count, size in rows}
+
+    def rows(self):
+        """Yield (filename, kind, timestamp, size) for every photo."""
+        with self.lock:
+            rows = self.db.execute("SELECT filename, kind, timestamp, size FROM photos").fetchall()
+        yield from rows
+
+    def totals(self):
+        """(photo count, total bytes) without touching the disk."""
+        with self.lock:
+            return self.count, self.total_bytes
+
+    def sync(self):
+        """Make the index match the folder again. Only new files get stat-ed."""
+        on_disk = {f for f in os.listdir(self.photo_dir) if f.endswith('.jpg')}
+        with self.lock:
+            indexed = {row[0] for row in self.db.execute("SELECT filename FROM photos")}
+        added = on_disk - indexed
+        removed = indexed - on_disk
+        for filename in removed:
+            self.remove(filename)
+        for filename in added:
+            width, height = jpeg_dimensions(os.path.join(self.photo_dir, filename))
+            try:
+                self.add(filename, width, height)
+            except OSError:
+                pass  # Deleted while we were looking at it
+        return len(added), len(removed)
+
+
+photo_index = PhotoIndex(INDEX_DB, SAVE_DIR)
+photo_index.sync()
+
+
+# ============================================================
+# THUMBNAILS - Small previews for the gallery
+# ============================================================
+# The gallery used to load every full 1280x720 photo into a 300x200 card.
+# A background worker now makes a small JPEG for each photo (right after
+# capture, straight from the frame in memory) and backfills any that are
+# missing. Thumbnails live in THUMB_DIR and the least recently viewed are
+# evicted once they take more than THUMB_MAX_MB. Views are remembered in
+# memory and written to the index in one go when eviction needs them.
+
+class ThumbnailWorker:
+    """Background thread that creates, backfills and evicts thumbnails."""
+
+    def __init__(self, index, photo_dir, thumb_dir):
+        self.index = index
+        self.photo_dir = photo_dir
+        self.thumb_dir = thumb_dir
+        self.jobs = queue.Queue(maxsize=200)
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.used = {}               # {filename: time served} not yet written to the index
+        self.used_lock = threading.Lock()
+        os.makedirs(thumb_dir, exist_ok=True)
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name="thumbnailer", daemon=True)
+            self.thread.start()
+
+    def request(self, filename, frame=None):
+        """Queue a thumbnail. Pass the frame if you have it to skip re-reading the file."""
+        self.start()
+        if frame is not None:
+            frame = self.shrink(frame)  # Don't keep full-size frames waiting in the queue
+        try:
+            self.jobs.put_nowait((filename, frame))
+        except queue.Full:
+            pass  # The backfill will pick it up later
+
+    def backfill(self):
+        """Queue a pass that fills in missing thumbnails, newest first."""
+        self.request(None)
+
+    def touch(self, filename):
+        """Note that a thumbnail was just served, so it's the last to be evicted."""
+        with self.used_lock:
+            self.used[filename] = time.time()
+
+    @staticmethod
+    def shrink(frame):
+        """A Frame or image scaled to THUMB_WIDTH pixels wide."""
+        if isinstance(frame, Frame):
+            frame = frame.reduced(THUMB_WIDTH)
+        height, width = frame.shape[:2]
+        if width == THUMB_WIDTH:
+            return frame
+        thumb_height = max(1, round(height * THUMB_WIDTH / width))
+        return cv2.resize(frame, (THUMB_WIDTH, thumb_height), interpolation=cv2.INTER_AREA)
+
+    def make(self, filename, frame=None):
+        """Create one thumbnail right now. Returns True if it exists afterwards."""
+        thumb_path = os.path.join(self.thumb_dir, filename)
+        if frame is None:
+            # Decoding at 1/4 size is much cheaper than a full decode
+            frame = cv2.imread(os.path.join(self.photo_dir, filename), cv2.IMREAD_REDUCED_COLOR_4)
+            if frame is None:
+                return False
+        thumb = self.shrink(frame)
+        if not cv2.imwrite(thumb_path, thumb, [cv2.IMWRITE_JPEG_QUALITY, THUMB_QUALITY]):
+            return False
+        if not self.index.set_thumb(filename, os.path.getsize(thumb_path)):
+            # The photo was deleted while we were working on it
+            self.remove(filename)
+            return False
+        self.evict(keep=filename)
+        return True
+
+    def remove(self, filename):
+        """Delete a photo's thumbnail file (the index row is handled by the caller)."""
+        try:
+            os.remove(os.path.join(self.thumb_dir, filename))
+        except FileNotFoundError:
+            pass
+
+    def remove_all(self):
+        for f in os.listdir(self.thumb_dir):
+            self.remove(f)
+
+    def evict(self, keep=None):
+        """Drop the least recently viewed thumbnails until we're back under THUMB_MAX_MB.
+
+        keep is never evicted (the thumbnail that was just made for a viewer).
+        """
+        max_bytes = THUMB_MAX_MB * 1024 * 1024
+        if self.index.thumb_bytes <= max_bytes:
+            return
+        with self.used_lock:
+            used, self.used = self.used, {}
+        if used:
+            self.index.touch_thumbs(used)
+        while self.index.thumb_bytes > max_bytes:
+            stale = [f for f in self.index.stale_thumbs(limit=20) if f != keep]
+            if not stale:
+                break
+            for filename in stale:
+                if self.index.thumb_bytes <= max_bytes:
+                    break
+                self.remove(filename)
+                self.index.set_thumb(filename, 0)
+
+    def _backfill(self):
+        # Clear out thumbnails whose photos are gone
+        for filename in os.listdir(self.thumb_dir):
+            if self.index.get(filename) is None:
+                self.remove(filename)
+        # Newest first, and stop before the budget would start evicting
+        max_bytes = THUMB_MAX_MB * 1024 * 1024
+        while self.index.thumb_bytes < max_bytes:
+            missing = self.index.missing_thumbs(limit=20)
+            made = 0
+            for filename in missing:
+                made += self.make(filename)
+            if made == 0:
+                break
+
+    def _run(self):
+        while True:
+            filename, frame = self.jobs.get()
+            try:
+                if filename is None:
+                    self._backfill()
+                else:
+                    self.make(filename, frame)
+            except Exception as e:
+                print(f"⚠️ Thumbnail failed for {filename}: {e}")
+
+
+thumbnails = ThumbnailWorker(photo_index, SAVE_DIR, THUMB_DIR)
+
+
+# ============================================================
+# DISK WRITER - Save photos in the background
+# ============================================================
+# JPEG compression plus an SD card write can take longer than the
+# capture itself. /capture, /burst and auto-capture now hand the frame to
+# a small pool of writer threads and return straight away with a job id
+# that /jobs/<id> can be polled with. The queue is bounded: when the card
+# can't keep up we either wait a little (backpressure) or drop the photo,
+# depending on WRITER_FULL_POLICY. Pending photos are flushed at exit.
+
+class DiskWriter:
+    """Bounded queue of (frame, filename, encode params) jobs plus worker threads."""
+
+    MAX_JOB_HISTORY = 500            # How many finished jobs /jobs/<id> remembers
+
+    def __init__(self, index, thumbs, save_dir):
+        self.index = index
+        self.thumbs = thumbs
+        self.save_dir = save_dir
+        self.jobs = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.status = OrderedDict()  # job id -> {"status", "filename", ...}
+        self.ids = itertools.count(1)
+        self.threads = []
+        self.accepting = True
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(WRITER_THREADS):
+                thread = threading.Thread(target=self._run, name=f"disk-writer-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _set_status(self, job_id, count=None, **fields):
+        with self.lock:
+            if count is not None:
+                setattr(self, count, getattr(self, count) + 1)
+            self.status.setdefault(job_id, {}).update(fields)
+            self.status.move_to_end(job_id)
+            while len(self.status) > self.MAX_JOB_HISTORY:
+                self.status.popitem(last=False)
+
+    def submit(self, frame, filename, params=None, on_done=None, meta=None, timestamp=None):
+        """Queue a photo to be saved. Returns the job id, or None if it was dropped.
+
+        timestamp is when the frame was grabbed (default: read from the filename).
+        """
+        self.start()
+        job_id = next(self.ids)
+        if not self.accepting:
+            self._set_status(job_id, count="dropped", status="dropped", filename=filename)
+            return None
+        self._set_status(job_id, status="queued", filename=filename)
+        job = (job_id, frame, filename, params or [], on_done, meta, timestamp)
+        try:
+            if WRITER_FULL_POLICY == "block":
+                self.jobs.put(job, timeout=WRITER_BLOCK_SECONDS)
+            else:
+                self.jobs.put_nowait(job)
+        except queue.Full:
+            self._set_status(job_id, count="dropped", status="dropped")
+            print(f"⚠️ Writer queue full, dropped {filename}")
+            return None
+        return job_id
+
+    def job(self, job_id):
+        with self.lock:
+            info = self.status.get(job_id)
+            return dict(info) if info is not None else None
+
+    def stats(self):
+        return {
+            "queued": self.jobs.qsize(),
+            "queue_size": WRITER_QUEUE_SIZE,
+            "written": self.written,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+    def flush(self):
+        """Wait until every queued photo is on disk."""
+        self.jobs.join()
+
+    def shutdown(self):
+        """Stop taking new photos and finish the ones already queued."""
+        self.accepting = False
+        if self.threads:
+            self.flush()
+
+    def new_job(self, filename):
+        """Get a job id for a photo that will be saved outside the queue (e.g. bursts)."""
+        job_id = next(self.ids)
+        self._set_status(job_id, status="queued", filename=filename)
+        return job_id
+
+    def drop(self, job_id):
+        """Mark a new_job() photo as dropped because there was no room for it."""
+        self._set_status(job_id, count="dropped", status="dropped")
+        print(f"⚠️ Writer queue full, dropped {self.job(job_id)['filename']}")
+
+    def save(self, job_id, frame, filename, params=None, on_done=None, meta=None, timestamp=None):
+        """Compress and write one photo right now, updating its job status."""
+        try:
+            self._set_status(job_id, status="writing")
+            filepath = os.path.join(self.save_dir, filename)
+            started = time.perf_counter()
+            if isinstance(frame, Frame) and frame.jpeg is not None and not params:
+                # Passthrough: the camera already compressed it, just write the bytes
+                data = frame.jpeg
+                width, height = frame.size
+            else:
+                pixels = as_pixels(frame)
+                # Only the encode takes a governor slot; a slow SD card write
+                # mustn't hold up the stream encodes waiting for one
+                with governor.encode_slot():
+                    ok, buffer = cv2.imencode(os.path.splitext(filename)[1] or '.jpg', pixels, params or [])
+                if not ok:
+                    raise OSError(f"cv2.imencode failed for {filepath}")
+                data = buffer.tobytes()
+                width, height = pixels.shape[1], pixels.shape[0]
+            # Write to a temp file and rename, so a crash never leaves half a JPEG behind
+            temp = filepath + ".tmp"
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, filepath)
+            imwrite_seconds.observe(time.perf_counter() - started)
+            size = len(data)
+            photo_bytes.observe(size)
+            bytes_written.inc(size)
+            self.index.add(filename, width, height, size=size, timestamp=timestamp, meta=meta)
+            self.thumbs.request(filename, frame)
+            self._set_status(job_id, count="written", status="done")
+            if on_done is not None:
+                on_done(filename)
+            return True
+        except Exception as e:
+            self._set_status(job_id, count="failed", status="failed", error=str(e))
+            print(f"⚠️ Failed to save {filename}: {e}")
+            return False
+
+    def _run(self):
+        while True:
+            job_id, frame, filename, params, on_done, meta, timestamp = self.jobs.get()
+            try:
+                self.save(job_id, frame, filename, params, on_done, meta, timestamp)
+            finally:
+                self.jobs.task_done()
+
+
+disk_writer = DiskWriter(photo_index, thumbnails, SAVE_DIR)
+atexit.register(disk_writer.shutdown)
+
+
+# ============================================================
+# BURST ENGINE - Grab first, save later
+# ============================================================
+# The old burst did read -> imwrite -> sleep for every frame, so the real
+# spacing was delay + compression + SD write. Now all frames are grabbed
+# into memory first, each one picked as the first frame the sensor
+# grabbed at or after its scheduled time. Only then are they compressed
+# and saved, in parallel, on a small thread pool.
+# Before saving, every frame gets a sharpness score (variance of the
+# Laplacian on a small crop around the brightest spot). With "keep" or
+# "min_sharpness" only the sharpest frames are written ("lucky imaging":
+# the atmosphere blurs most frames, a few come out crisp).
+
+def sharpness(frame):
+    """Variance of the Laplacian on a shrunk crop around the brightest spot. Higher = sharper."""
+    pixels = frame.reduced(SHARPNESS_WIDTH) if isinstance(frame, Frame) else frame
+    gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY) if pixels.ndim == 3 else pixels
+    if gray.shape[1] > SHARPNESS_WIDTH:
+        height = max(1, round(gray.shape[0] * SHARPNESS_WIDTH / gray.shape[1]))
+        gray = cv2.resize(gray, (SHARPNESS_WIDTH, height), interpolation=cv2.INTER_AREA)
+    # Center the crop on the brightness centroid (the moon, usually)
+    height, width = gray.shape
+    moments = cv2.moments(gray)
+    if moments["m00"] > 0:
+        cx, cy = moments["m10"] / moments["m00"], moments["m01"] / moments["m00"]
+    else:
+        cx, cy = width / 2, height / 2
+    half_w = max(8, int(width * SHARPNESS_ROI / 2))
+    half_h = max(8, int(height * SHARPNESS_ROI / 2))
+    x0 = int(min(max(cx - half_w, 0), max(width - 2 * half_w, 0)))
+    y0 = int(min(max(cy - half_h, 0), max(height - 2 * half_h, 0)))
+    roi = gray[y0:y0 + 2 * half_h, x0:x0 + 2 * half_w]
+    return float(cv2.Laplacian(roi, cv2.CV_64F).var())
+
+class BurstEngine:
+    """Grabs N evenly spaced frames into RAM, then saves them in parallel."""
+
+    def __init__(self, frames, writer):
+        self.frames = frames
+        self.writer = writer
+        self.pool = ThreadPoolExecutor(max_workers=BURST_ENCODE_THREADS, thread_name_prefix="burst-encode")
+        # The pool's own queue is unbounded, so cap the frames waiting in it
+        # the same way the disk writer caps its queue (WRITER_FULL_POLICY)
+        self.slots = threading.BoundedSemaphore(WRITER_QUEUE_SIZE + BURST_ENCODE_THREADS)
+
+    def _save(self, job_id, frame, filename, meta, timestamp):
+        try:
+            self.writer.save(job_id, frame, filename, meta=meta, timestamp=timestamp)
+        finally:
+            self.slots.release()
+
+    def submit(self, frame, filename, meta=None, timestamp=None):
+        """Queue one burst frame for the encode pool. Returns the job id, or None if it was dropped."""
+        job_id = self.writer.new_job(filename)
+        if WRITER_FULL_POLICY == "block":
+            got_slot = self.slots.acquire(timeout=WRITER_BLOCK_SECONDS)
+        else:
+            got_slot = self.slots.acquire(blocking=False)
+        if not got_slot:
+            self.writer.drop(job_id)
+            return None
+        self.pool.submit(self._save, job_id, frame, filename, meta, timestamp)
+        return job_id
+
+    def grab(self, count, delay):
+        """Grab count frames delay seconds apart. Returns [(frame, grab time), ...].
+
+        Each frame is the one grabbed nearest to when it was due, so the
+        spacing is off by at most half a camera frame period.
+        """
+        shots = []
+        last_seq = self.frames.latest_seq()
+        start = None
+        for i in range(count):
+            target = None if start is None else start + i * delay
+            if target is not None:
+                # Sleep until about a frame before this one is due...
+                period = 1.0 / self.frames.fps if self.frames.fps > 1 else 0.05
+                remaining = target - period - time.time()
+                if remaining > 0:
+                    time.sleep(remaining)
+            before = None            # (seq, frame, grab time) of the newest frame grabbed before target
+            while True:
+                seq, frame, grabbed_at = self.frames.wait_for_frame_timed(last_seq)
+                if frame is None or frame.stale:
+                    return shots  # Camera stopped, save what we have
+                last_seq = seq
+                if target is None:
+                    break
+                if grabbed_at < target:
+                    before = (seq, frame, grabbed_at)
+                    continue
+                # ...then keep whichever of the frames either side of it is nearer
+                if before is not None and target - before[2] < grabbed_at - target:
+                    last_seq, frame, grabbed_at = before  # The later one may suit the next frame
+                break
+            if start is None:
+                start = grabbed_at
+            shots.append((frame, grabbed_at))
+        return shots
+
+    def run(self, count, delay, prefix="burst", earlier=None, keep=None, min_sharpness=None):
+        """Grab a burst and queue it for saving. Returns a summary dict.
+
+        earlier is a list of (frame, grab time) from before the request
+        (see PRE-TRIGGER BUFFER) that goes at the start of the burst.
+        keep (top-K) and min_sharpness limit which frames are saved.
+        """
+        count = max(1, min(int(count), BURST_MAX_FRAMES))
+        delay = max(0.0, min(float(delay), BURST_MAX_DELAY))
+        earlier = earlier or []
+        grabbed = self.grab(count, delay)
+        shots = earlier + grabbed
+        # How far each grabbed frame is from when it was due
+        errors = [t - (grabbed[0][1] + i * delay) for i, (_, t) in enumerate(grabbed)]
+
+        scores = [sharpness(frame) for frame, _ in shots]
+        chosen = [i for i, score in enumerate(scores) if min_sharpness is None or score >= min_sharpness]
+        if keep is not None:
+            chosen = sorted(chosen, key=lambda i: scores[i], reverse=True)[:max(0, int(keep))]
+        ranks = {i: rank for rank, i in enumerate(sorted(range(len(shots)), key=lambda i: -scores[i]), 1)}
+
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        files, job_ids, dropped = [], [], 0
+        for i in sorted(chosen):
+            frame, grabbed_at = shots[i]
+            filename = f"{prefix}_{timestamp}_{i+1}.jpg"
+            meta = {"sharpness": round(scores[i], 2), "sharpness_rank": ranks[i],
+                    "burst_frame": i + 1, "burst_frames": len(shots)}
+            job_id = self.submit(frame, filename, meta, timestamp=grabbed_at)
+            if job_id is None:
+                dropped += 1  # No room to save it
+                continue
+            files.append(filename)
+            job_ids.append(job_id)
+
+        times = [grabbed_at for _, grabbed_at in shots]
+        span = times[-1] - times[0] if len(times) > 1 else 0.0
+        return {
+            "files": files,
+            "job_ids": job_ids,
+            "count": len(files),
+            "requested_delay": delay,
+            "started_at": datetime.fromtimestamp(times[0]).isoformat() if times else None,
+            "offsets": [round(t - times[0], 4) for t in times],
+            "intervals": [round(b - a, 4) for a, b in zip(times, times[1:])],
+            "capture_fps": round((len(times) - 1) / span, 2) if span > 0 else None,
+            "timing_errors": [round(e, 4) for e in errors],
+            "max_timing_error": round(max((abs(e) for e in errors), default=0.0), 4),
+            "pre_trigger": len(earlier),
+            "grabbed": len(shots),
+            "scores": [round(score, 2) for score in scores],
+            "kept": [i + 1 for i in sorted(chosen)],
+            "discarded": len(shots) - len(chosen),
+            "dropped": dropped,
+        }
+
+
+burst_engine = BurstEngine(broadcaster, disk_writer)
+
+
+# ============================================================
+# PRE-TRIGGER BUFFER - Reach back to before the button was pressed
+# ============================================================
+# By the time someone sees something on the (slightly delayed) live feed
+# and clicks Capture, the moment is usually gone. A background thread
+# keeps the last PRETRIGGER_SECONDS of frames at PRETRIGGER_FPS as JPEG
+# bytes (about 1/20 the size of raw pixels) within a PRETRIGGER_MB
+# budget. /capture and /burst can then save frames from before the
+# request, and those are written to disk as-is without re-encoding.
+# Encoding every frame isn't free on a Pi Zero, so it's off by default
+# and slows down (or pauses) in the governor's hotter tiers. Passthrough
+# frames are already JPEGs and always go in at the full rate.
+
+class PreTriggerBuffer:
+    """Ring of recent (grab time, JPEG bytes), bounded by age and memory."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.lock = threading.Lock()
+        self.ring = deque()          # (grabbed_at, jpeg bytes), oldest first
+        self.bytes = 0
+        self.thread = None
+
+    def start(self):
+        if not PRETRIGGER_ENABLED:
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name="pre-trigger", daemon=True)
+            self.thread.start()
+
+    def add(self, grabbed_at, jpeg):
+        with self.lock:
+            self.ring.append((grabbed_at, jpeg))
+            self.bytes += len(jpeg)
+            cutoff = grabbed_at - PRETRIGGER_SECONDS
+            budget = int(PRETRIGGER_MB * 1024 * 1024)
+            while self.ring and (self.bytes > budget or self.ring[0][0] < cutoff):
+                _, old = self.ring.popleft()
+                self.bytes -= len(old)
+
+    def select(self, start, end=None, spacing=0.0):
+        """[(Frame, grab time), ...] grabbed between start and end, at least spacing apart."""
+        end = time.time() if end is None else end
+        with self.lock:
+            entries = [e for e in self.ring if start <= e[0] <= end]
+        chosen = []
+        for grabbed_at, jpeg in entries:
+            if not chosen or grabbed_at - chosen[-1][1] >= spacing:
+                chosen.append((Frame(jpeg=jpeg), grabbed_at))
+        return chosen
+
+    def closest(self, when):
+        """(Frame, grab time) of the buffered frame nearest to when, or (None, None)."""
+        with self.lock:
+            if not self.ring:
+                return None, None
+            grabbed_at, jpeg = min(self.ring, key=lambda e: abs(e[0] - when))
+        return Frame(jpeg=jpeg), grabbed_at
+
+    def stats(self):
+        with self.lock:
+            span = self.ring[-1][0] - self.ring[0][0] if self.ring else 0.0
+            return {
+                "enabled": PRETRIGGER_ENABLED,
+                "frames": len(self.ring),
+                "seconds": round(span, 2),
+                "bytes": self.bytes,
+                "budget_bytes": int(PRETRIGGER_MB * 1024 * 1024),
+                "fps": self.fps(),
+            }
+
+    def fps(self):
+        """Frames per second to encode into the buffer in the current governor tier."""
+        tier_fps = PRETRIGGER_TIER_FPS.get(GOVERNOR_TIERS[governor.tier][0])
+        return PRETRIGGER_FPS if tier_fps is None else min(PRETRIGGER_FPS, tier_fps)
+
+    def _run(self):
+        last_seq = 0
+        next_due = 0.0
+        while True:
+            wait = next_due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            seq, frame, grabbed_at = self.frames.wait_for_frame_timed(last_seq)
+            if frame is None:
+                continue
+            last_seq = seq
+            if frame.stale:
+                continue  # Camera is down, keep the real history
+            passthrough = isinstance(frame, Frame) and frame.jpeg is not None
+            fps = PRETRIGGER_FPS if passthrough else self.fps()
+            if fps <= 0:
+                next_due = time.time() + GOVERNOR_INTERVAL  # Paused while it's this hot
+                continue
+            next_due = time.time() + 1.0 / fps
+            try:
+                if passthrough:
+                    jpeg = frame.jpeg  # Already compressed
+                else:
+                    with governor.encode_slot():
+                        ok, buffer = cv2.imencode('.jpg', as_pixels(frame),
+                                                  [cv2.IMWRITE_JPEG_QUALITY, PRETRIGGER_QUALITY])
+                    if not ok:
+                        continue
+                    jpeg = buffer.tobytes()
+                self.add(grabbed_at, jpeg)
+            except Exception as e:
+                print(f"⚠️ Pre-trigger frame failed: {e}")
+
+
+pretrigger = PreTriggerBuffer(broadcaster)
+
+
+# ============================================================
+# TIME-LAPSE - Build videos on the Pi instead of downloading every frame
+# ============================================================
+# Every auto-capture is appended to a rolling MJPEG .avi as it happens,
+# so there's nothing to re-encode later. A new segment starts every
+# TIMELAPSE_SEGMENT_FRAMES frames, which limits what's lost if the Pi
+# loses power mid-file. /timelapse/build can also stitch any date range
+# of existing photos into a video, reading one frame at a time from disk.
+# Videos aren't photos, so the photo quota doesn't see them: they get
+# their own TIMELAPSE_MAX_MB and the oldest finished ones are deleted
+# first whenever a segment or build is started or finished.
+
+class TimelapseRecorder:
+    """Appends frames to rolling .avi segments and builds videos from photo ranges."""
+
+    MAX_BUILD_HISTORY = 20           # Finished builds whose progress videos() still reports
+
+    def __init__(self, index, photo_dir, out_dir):
+        self.index = index
+        self.photo_dir = photo_dir
+        self.out_dir = out_dir
+        self.lock = threading.Lock()
+        self.writer = None
+        self.segment = None
+        self.segment_frames = 0
+        self.size = None
+        self.builds = {}             # output filename -> progress of a /timelapse/build
+        self.build_ids = itertools.count(1)
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _open(self, name, size):
+        fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+        writer = cv2.VideoWriter(os.path.join(self.out_dir, name), fourcc, TIMELAPSE_FPS, size)
+        if not writer.isOpened():
+            raise OSError(f"Couldn't open {name} for writing")
+        return writer
+
+    def add(self, frame):
+        """Append one frame to the current segment, starting a new one if needed."""
+        frame = as_pixels(frame)
+        with self.lock:
+            size = (frame.shape[1], frame.shape[0])
+            if self.writer is not None and size != self.size:
+                self._close()  # Camera resolution changed
+            if self.writer is None:
+                self.segment = f"timelapse_{datetime.now().strftime('%Y%m%d_%H%M%S')}.avi"
+                self.writer = self._open(self.segment, size)
+                self.size = size
+                self.segment_frames = 0
+                self._trim()
+            self.writer.write(frame)
+            self.segment_frames += 1
+            if self.segment_frames >= TIMELAPSE_SEGMENT_FRAMES:
+                self._close()
+                self._trim()
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+    def close(self):
+        """Finish the current segment so it's playable."""
+        with self.lock:
+            self._close()
+
+    def build(self, name, kind=None, start=None, end=None, fps=TIMELAPSE_FPS, width=None):
+        """Stitch existing photos (oldest first) into one video. Meant for a background thread."""
+        progress = self.builds[name]
+        writer = None
+        try:
+            for photo in self.index.iter_photos(kind=kind, start=start, end=end):
+                frame = cv2.imread(os.path.join(self.photo_dir, photo['filename']))
+                if frame is None:
+                    continue  # Deleted since we listed it
+                if writer is None:
+                    if width is None:
+                        width = frame.shape[1]
+                    size = (width, max(1, round(frame.shape[0] * width / frame.shape[1])))
+                    writer = cv2.VideoWriter(os.path.join(self.out_dir, name),
+                                             cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+                    if not writer.isOpened():
+                        raise OSError(f"Couldn't open {name} for writing at {size[0]}x{size[1]}, {fps} fps")
+                if (frame.shape[1], frame.shape[0]) != size:
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                writer.write(frame)
+                progress["frames"] += 1
+            progress["status"] = "done" if writer is not None else "empty"
+        except Exception as e:
+            progress["status"] = "failed"
+            progress["error"] = str(e)
+        finally:
+            if writer is not None:
+                writer.release()
+            self.trim()
+
+    def start_build(self, kind=None, start=None, end=None, fps=TIMELAPSE_FPS, width=None):
+        """Start a build in the background and return the output filename."""
+        name = f"timelapse_build_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{next(self.build_ids)}.avi"
+        with self.lock:
+            finished = [n for n, p in self.builds.items() if p["status"] != "running"]
+            for old in finished[:max(0, len(finished) - self.MAX_BUILD_HISTORY)]:
+                del self.builds[old]
+            self.builds[name] = {"status": "running", "frames": 0}
+        threading.Thread(target=self.build, args=(name, kind, start, end, fps, width),
+                         name="timelapse-build", daemon=True).start()
+        return name
+
+    def _busy(self, name):
+        """True for the segment being recorded and builds still being written."""
+        if name == self.segment and self.writer is not None:
+            return True
+        return self.builds.get(name, {}).get("status") == "running"
+
+    def _trim(self):
+        """Delete the oldest finished videos until they fit in TIMELAPSE_MAX_MB. Needs self.lock."""
+        files = []
+        for name in os.listdir(self.out_dir):
+            if name.endswith('.avi'):
+                try:
+                    stat = os.stat(os.path.join(self.out_dir, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, name, stat.st_size))
+        total = sum(size for _, _, size in files)
+        max_bytes = TIMELAPSE_MAX_MB * 1024 * 1024
+        for _, name, size in sorted(files):
+            if total <= max_bytes:
+                break
+            if self._busy(name):
+                continue
+            print(f"🗑️ Time-lapse over {TIMELAPSE_MAX_MB} MB, deleting {name}")
+            self._remove(name)
+            total -= size
+
+    def trim(self):
+        with self.lock:
+            self._trim()
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.out_dir, name))
+        except FileNotFoundError:
+            pass
+        self.builds.pop(name, None)
+
+    def remove(self, name):
+        """Delete one video. Returns False if there's no such video or it's still being written."""
+        with self.lock:
+            if not name.endswith('.avi') or name not in os.listdir(self.out_dir) or self._busy(name):
+                return False
+            self._remove(name)
+            return True
+
+    def remove_all(self):
+        """Stop the current segment and delete every finished video. Returns how many were deleted."""
+        with self.lock:
+            self._close()
+            names = [n for n in os.listdir(self.out_dir) if n.endswith('.avi') and not self._busy(n)]
+            for name in names:
+                self._remove(name)
+            return len(names)
+
+    def total_bytes(self):
+        total = 0
+        for name in os.listdir(self.out_dir):
+            try:
+                total += os.path.getsize(os.path.join(self.out_dir, name))
+            except FileNotFoundError:
+                pass
+        return total
+
+    def videos(self):
+        """Every video in the time-lapse folder, with size and build progress."""
+        result = []
+        with self.lock:
+            for name in sorted(os.listdir(self.out_dir)):
+                if not name.endswith('.avi'):
+                    continue
+                try:
+                    entry = {"filename": name, "size": os.path.getsize(os.path.join(self.out_dir, name))}
+                except FileNotFoundError:
+                    continue
+                if name == self.segment and self.writer is not None:
+                    entry["status"] = "recording"
+                    entry["frames"] = self.segment_frames
+                elif name in self.builds:
+                    entry.update(self.builds[name])
+                result.append(entry)
+        return result
+
+
+timelapse = TimelapseRecorder(photo_index, SAVE_DIR, TIMELAPSE_DIR)
+atexit.register(timelapse.close)
+
+
+# ============================================================
+# STACKING - Many noisy frames into one clean moon shot
+# ============================================================
+# Night frames are noisy; averaging N of them cuts the noise by about
+# sqrt(N). Each frame is lined up with the first one by phase
+# correlation (an FFT of both, via cv2.phaseCorrelate, which also gives
+# sub-pixel shifts) and shifted into place. "mean" just adds it to a
+# running sum. "median" and "sigma" hold up to STACK_CHUNK_FRAMES aligned
+# frames, combine that chunk with NumPy in strips of rows, and add the
+# result to the running sum, so 100 frames never need more than one
+# chunk in RAM. (That makes "median" the average of per-chunk medians.)
+
+class FrameStacker:
+    """Aligns frames to the first one and combines them a chunk at a time."""
+
+    STRIP_ROWS = 90                  # Rows combined at once (keeps float32 temporaries small)
+
+    def __init__(self, method=STACK_METHOD, sigma=STACK_SIGMA, align=True, chunk=STACK_CHUNK_FRAMES):
+        if method not in ("mean", "median", "sigma"):
+            raise ValueError(f"Unknown stacking method {method!r}")
+        self.method = method
+        self.sigma = sigma
+        self.align = align
+        self.chunk = max(2, chunk)
+        self.reference = None        # Grayscale float32 of the first frame
+        self.window = None           # Hanning window for phaseCorrelate
+        self.sum = None              # float32 running sum of accepted pixel values
+        self.weight = None           # float32 how many values went into each pixel
+        self.pending = []            # (aligned pixels, valid mask) waiting to be combined
+        self.shifts = []             # (dx, dy) applied to each frame
+        self.count = 0
+
+    def add(self, pixels):
+        """Align one BGR frame and fold it into the stack."""
+        if self.sum is not None and pixels.shape != self.sum.shape:
+            raise ValueError(f"Frame size {pixels.shape} doesn't match the stack {self.sum.shape}")
+        height, width = pixels.shape[:2]
+        mask = np.ones((height, width), np.float32)
+        dx = dy = 0.0
+        if self.align:
+            gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY).astype(np.float32)
+            if self.reference is None:
+                self.reference = gray
+                self.window = cv2.createHanningWindow((width, height), cv2.CV_32F)
+            else:
+                (dx, dy), _ = cv2.phaseCorrelate(self.reference, gray, self.window)
+                if abs(dx) > 0.01 or abs(dy) > 0.01:
+                    # Move it back onto the reference; uncovered edges get weight 0
+                    shift = np.float32([[1, 0, -dx], [0, 1, -dy]])
+                    pixels = cv2.warpAffine(pixels, shift, (width, height), flags=cv2.INTER_LINEAR)
+                    mask = cv2.warpAffine(mask, shift, (width, height), flags=cv2.INTER_LINEAR)
+        self.shifts.append((round(dx, 2), round(dy, 2)))
+        self.count += 1
+
+        if self.sum is None:
+            self.sum = np.zeros(pixels.shape, np.float32)
+            self.weight = np.zeros(pixels.shape, np.float32)
+        if self.method == "mean":
+            weights = mask[..., None]
+            self.sum += pixels * weights
+            self.weight += weights
+        else:
+            self.pending.append((pixels, mask > 0.99))
+            if len(self.pending) >= self.chunk:
+                self._combine_pending()
+
+    def _combine_pending(self):
+        """Median or sigma-clip the pending frames into the running sum, one strip at a time."""
+        if not self.pending:
+            return
+        frames = np.stack([p for p, _ in self.pending])          # (n, h, w, 3) uint8
+        valid = np.stack([m for _, m in self.pending])[..., None]  # (n, h, w, 1) bool
+        self.pending = []
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)      # All-NaN edges are expected
+            for y in range(0, frames.shape[1], self.STRIP_ROWS):
+                rows = slice(y, y + self.STRIP_ROWS)
+                block = np.where(valid[:, rows], frames[:, rows].astype(np.float32), np.nan)
+                if self.method == "median":
+                    seen = np.broadcast_to(valid[:, rows], block.shape).sum(axis=0)
+                    median = np.nan_to_num(np.nanmedian(block, axis=0))
+                    self.sum[rows] += median * seen
+                    self.weight[rows] += seen
+                else:
+                    mean = np.nanmean(block, axis=0)
+                    std = np.nanstd(block, axis=0)
+                    keep = np.abs(block - mean) <= self.sigma * std + 0.5
+                    self.sum[rows] += np.where(keep, block, 0).sum(axis=0)
+                    self.weight[rows] += keep.sum(axis=0)
+
+    def result(self):
+        """The combined image as uint8 BGR (None if nothing was added)."""
+        self._combine_pending()
+        if self.sum is None:
+            return None
+        stacked = self.sum / np.maximum(self.weight, 1e-6)
+        return np.clip(stacked + 0.5, 0, 255).astype(np.uint8)
+
+
+class StackEngine:
+    """Runs stacks in the background and saves the results as stack_*.jpg photos."""
+
+    def __init__(self, frames, index, writer, save_dir, ring=None):
+        self.frames = frames
+        self.ring = ring             # PreTriggerBuffer to take the most recent frames from
+        self.index = index
+        self.writer = writer
+        self.save_dir = save_dir
+        self.builds = OrderedDict()  # name -> progress dict
+        self.build_ids = itertools.count(1)
+
+    def burst_files(self, burst):
+        """Every file of a burst, in order, from a name like burst_20260101_203000."""
+        prefix = burst.rsplit('.', 1)[0]
+        parts = prefix.split('_')
+        if len(parts) == 4:  # Given one frame's filename, use its whole burst
+            prefix = '_'.join(parts[:3])
+        files = [f for f in self.index.with_prefix(prefix + '_') if photo_kind(f) != 'roi']
+        return sorted(files, key=lambda f: int(re.sub(r'\D', '', f.rsplit('_', 1)[-1]) or 0))
+
+    def _from_files(self, files):
+        for filename in files:
+            pixels = cv2.imread(os.path.join(self.save_dir, filename))
+            if pixels is not None:
+                yield pixels
+
+    def _recent(self, count):
+        """Up to the last count frames from the pre-trigger buffer, oldest first."""
+        if self.ring is None or not PRETRIGGER_ENABLED:
+            return []
+        now = time.time()
+        return [frame for frame, _ in self.ring.select(now - PRETRIGGER_SECONDS, now)[-count:]]
+
+    def _from_camera(self, count, recent=()):
+        """The recent buffered frames, then new camera frames until there are count."""
+        last_seq = self.frames.latest_seq()
+        for frame in recent:
+            yield as_pixels(frame)
+        for _ in range(count - len(recent)):
+            seq, frame = self.frames.wait_for_frame(last_seq)
+            if frame is None or frame.stale:
+                return  # Camera stopped, stack what we have
+            last_seq = seq
+            yield as_pixels(frame)
+
+    def build(self, name, source, method, sigma, align):
+        progress = self.builds[name]
+        try:
+            stacker = FrameStacker(method, sigma, align)
+            for pixels in source:
+                stacker.add(pixels)
+                progress["frames"] = stacker.count
+            stacked = stacker.result()
+            progress["shifts"] = stacker.shifts
+            if stacked is None:
+                progress["status"] = "empty"
+                return
+            job_id = self.writer.submit(stacked, name, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            progress.update(status="done" if job_id is not None else "dropped", job_id=job_id)
+        except Exception as e:
+            progress["status"] = "failed"
+            progress["error"] = str(e)
+
+    def start(self, files=None, count=None, method=STACK_METHOD, sigma=STACK_SIGMA, align=True):
+        """Stack photos from disk (files) or the last count camera frames. Returns the output filename."""
+        FrameStacker(method)  # Fail now, not in the background, on a bad method
+        if files:
+            files = files[:STACK_MAX_FRAMES]
+            source = self._from_files(files)
+        else:
+            count = max(1, min(int(count or 1), STACK_MAX_FRAMES))
+            # Buffered frames are picked here, not in the build thread, so the stack
+            # is of the moment of the request
+            source = self._from_camera(count, self._recent(count))
+        name = f"stack_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{next(self.build_ids)}.jpg"
+        self.builds[name] = {"status": "running", "frames": 0, "method": method}
+        while len(self.builds) > 50:
+            self.builds.popitem(last=False)
+        threading.Thread(target=self.build, args=(name, source, method, sigma, align),
+                         name="stack-build", daemon=True).start()
+        return name
+
+
+stacker = StackEngine(broadcaster, photo_index, disk_writer, SAVE_DIR, ring=pretrigger)
+
 
 # ============================================================
 # HTML TEMPLATES - The web pages
@@ -175,32 +2677,38 @@ GALLERY_TEMPLATE = '''
         <h1>📸 Photo Gallery</h1>
         <div>
             <a href="/" class="back-btn">← Back to Live Feed</a>
-            {% if files %}
+            {% if photo_count %}
+            <a href="/export" class="back-btn">📦 Download All (ZIP)</a>
             <button class="delete-all-btn" onclick="deleteAll()">🗑️ Delete All</button>
             {% endif %}
         </div>
     </div>
     
     <div class="stats">
-        <strong>{{ files|length }}</strong> photos | 
+        <strong>{{ photo_count }}</strong> photos | 
         <strong>{{ "%.1f"|format(size_mb) }} MB</strong> used
     </div>
     
-    {% if files %}
-    <div class="gallery-grid">
-        {% for filename in files %}
-        <div class="photo-card" id="card-{{ loop.index }}">
-            <img src="/photos/{{ filename }}" alt="{{ filename }}" loading="lazy">
+    {% if photos %}
+    <div class="gallery-grid" id="gallery-grid">
+        {% for photo in photos %}
+        <div class="photo-card">
+            <a href="/photos/{{ photo.filename }}" target="_blank">
+                <img src="/thumbs/{{ photo.filename }}" alt="{{ photo.filename }}" loading="lazy">
+            </a>
             <div class="photo-info">
-                <h3>{{ filename }}</h3>
+                <h3>{{ photo.filename }}</h3>
                 <div class="photo-actions">
-                    <a href="/download/{{ filename }}" class="download-btn">⬇️ Download</a>
-                    <button class="delete-btn" onclick="deletePhoto('{{ filename }}', 'card-{{ loop.index }}')">🗑️ Delete</button>
+                    <a href="/download/{{ photo.filename }}" class="download-btn">⬇️ Download</a>
+                    <button class="delete-btn" onclick="deletePhoto('{{ photo.filename }}', this)">🗑️ Delete</button>
                 </div>
             </div>
         </div>
         {% endfor %}
     </div>
+    <div class="empty-state" id="load-more" data-cursor="{{ next_cursor or '' }}">
+        {% if next_cursor %}Loading more...{% endif %}
+    </div>
     {% else %}
     <div class="empty-state">
         <h2>No photos yet!</h2>
@@ -209,17 +2717,59 @@ GALLERY_TEMPLATE = '''
     {% endif %}
     
     <script>
-        function deletePhoto(filename, cardId) {
+        function deletePhoto(filename, button) {
             if (!confirm('Delete ' + filename + '?')) return;
             fetch('/delete/' + filename, { method: 'POST' })
                 .then(r => r.json())
                 .then(data => {
                     if (data.status === 'success') {
-                        document.getElementById(cardId).remove();
+                        button.closest('.photo-card').remove();
                     }
                 });
         }
         
+        // Build a card for a photo from /api/photos (same markup as the server renders)
+        function makeCard(photo) {
+            const card = document.createElement('div');
+            card.className = 'photo-card';
+            card.innerHTML =
+                '<a target="_blank"><img loading="lazy"></a>' +
+                '<div class="photo-info"><h3></h3><div class="photo-actions">' +
+                '<a class="download-btn">⬇️ Download</a>' +
+                '<button class="delete-btn">🗑️ Delete</button></div></div>';
+            card.querySelector('a').href = photo.url;
+            card.querySelector('img').src = photo.thumb_url;
+            card.querySelector('img').alt = photo.filename;
+            card.querySelector('h3').textContent = photo.filename;
+            card.querySelector('.download-btn').href = '/download/' + photo.filename;
+            const button = card.querySelector('.delete-btn');
+            button.onclick = () => deletePhoto(photo.filename, button);
+            return card;
+        }
+        
+        // Infinite scroll: fetch the next page when the bottom comes into view
+        const loadMore = document.getElementById('load-more');
+        let loading = false;
+        if (loadMore && loadMore.dataset.cursor) {
+            const observer = new IntersectionObserver(entries => {
+                if (!entries[0].isIntersecting || loading || !loadMore.dataset.cursor) return;
+                loading = true;
+                fetch('/api/photos?cursor=' + encodeURIComponent(loadMore.dataset.cursor))
+                    .then(r => r.json())
+                    .then(data => {
+                        const grid = document.getElementById('gallery-grid');
+                        data.photos.forEach(photo => grid.appendChild(makeCard(photo)));
+                        loadMore.dataset.cursor = data.next_cursor || '';
+                        if (!data.next_cursor) {
+                            loadMore.textContent = '';
+                            observer.disconnect();
+                        }
+                    })
+                    .finally(() => { loading = false; });
+            }, { rootMargin: '600px' });
+            observer.observe(loadMore);
+        }
+        
         function deleteAll() {
             if (!confirm('Delete ALL photos? This cannot be undone!')) return;
             fetch('/delete_all', { method: 'POST' })
@@ -235,6 +2785,9 @@ GALLERY_TEMPLATE = '''
 </html>
 '''
 
+# Compiled once at startup instead of on every gallery request
+gallery_page = app.jinja_env.from_string(GALLERY_TEMPLATE)
+
 @app.route('/')
 def index():
     return '''
@@ -487,8 +3040,9 @@ def index():
             <!-- LIVE FEED -->
             <div id="feed" class="content-box">
                 <h1>Live Camera Feed</h1>
-                <img src="/video" class="video-feed" alt="Live camera feed">
+                <img src="/video" class="video-feed" id="video-feed" alt="Live camera feed">
                 <p style="color: #94a3b8; font-size: 12px;">Streaming at low resolution for speed</p>
+                <button class="nav-button" id="roi-button" onclick="toggleRoi()">🎯 Track target</button>
             </div>
 
             <!-- SYSTEM INFO -->
@@ -508,7 +3062,7 @@ def index():
                     <input type="number" id="interval-input" min="5" max="3600" value="10">
                 </div>
                 <div class="settings-group">
-                    <label>Stream quality (1-100)</label>
+                    <label>Max stream quality (1-100)</label>
                     <input type="number" id="quality-input" min="1" max="100" value="70">
                 </div>
                 <button class="nav-button" onclick="saveSettings()" style="margin-top: 15px;">💾 Save Settings</button>
@@ -536,6 +3090,14 @@ def index():
                 fb.classList.add('show');
             }
 
+            // Switch the live feed between the whole frame and the tracked target
+            function toggleRoi() {
+                const feed = document.getElementById('video-feed');
+                const tracking = feed.src.indexOf('roi=1') === -1;
+                feed.src = tracking ? '/video?roi=1' : '/video';
+                document.getElementById('roi-button').textContent = tracking ? '🖼️ Whole frame' : '🎯 Track target';
+            }
+
             // Capture a single photo
             function capturePhoto() {
                 fetch('/capture', { method: 'POST' })
@@ -572,6 +3134,9 @@ def index():
                     .then(data => {
                         let html = '';
                         html += '<div class="stat-row"><span>🌡️ CPU Temp</span><span>' + data.cpu_temp + '</span></div>';
+                        html += '<div class="stat-row"><span>⚙️ CPU Load</span><span>' + data.cpu_load + ' (' + data.cpu_percent + ')</span></div>';
+                        html += '<div class="stat-row"><span>🧠 Memory</span><span>' + data.memory + '</span></div>';
+                        html += '<div class="stat-row"><span>🔥 Governor</span><span>' + data.governor_tier + '</span></div>';
                         html += '<div class="stat-row"><span>💾 Disk Used</span><span>' + data.disk_used + ' / ' + data.disk_total + ' (' + data.disk_percent + ')</span></div>';
                         html += '<div class="stat-row"><span>💽 Disk Free</span><span>' + data.disk_free + '</span></div>';
                         html += '<div class="stat-row"><span>📸 Photos</span><span>' + data.photo_count + ' (' + data.photos_size + ')</span></div>';
@@ -620,48 +3185,177 @@ def index():
     '''
 
 
-@app.route('/video')
-def video():
-    """Stream live video to the browser."""
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+@app.route('/video')
+def video():
+    """Stream live video to the browser.
+
+    ?profile=N pins this viewer to STREAM_PROFILES[N] instead of adapting.
+    ?roi=1 streams a crop that follows the bright target (see ROI TRACKING).
+    """
+    profile = request.args.get('profile', type=int)
+    if profile is not None:
+        profile = min(max(profile, 0), len(STREAM_PROFILES) - 1)
+    roi = request.args.get('roi') in ('1', 'true', 'yes')
+    client = StreamClient(next(stream_client_ids), request.remote_addr, profile, roi)
+    governor.start()
+    return Response(gen_frames(client), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/stream/stats')
+def stream_stats():
+    """How much encoding work the shared stream cache is saving, plus each viewer's stream."""
+    stats = stream_encoder.stats()
+    with stream_clients_lock:
+        stats["clients"] = [c.stats() for c in stream_clients.values()]
+    stats["adaptive"] = ADAPTIVE_STREAM
+    stats["roi"] = roi_tracker.stats()
+    return jsonify(stats)
+
+
+# ============================================================
+# PHOTO CAPTURE - Take and save photos
+# ============================================================
+
+def json_object():
+    """(JSON body or {} without one, None), or (None, a 400 response) if the body isn't an object."""
+    data = request.json if request.is_json else {}
+    if not isinstance(data, dict):
+        return None, (jsonify({"status": "error", "message": "The JSON body must be an object"}), 400)
+    return data, None
+
+
+@app.route('/capture', methods=['POST'])
+def capture():
+    """Take a photo and save it (the file is written in the background).
+
+    Optional JSON body, both in seconds (see PRE-TRIGGER BUFFER):
+    offset - save the frame from this long before the request instead
+    before - also save the buffered frames from this long before it
+    Both need the pre-trigger buffer: 409 if it's off or doesn't go back
+    that far (for before, "pre_trigger_short" says it covered less).
+    "roi": true/false also saves (or doesn't) a crop of the tracked
+    target, overriding ROI_SAVE_CROPS.
+    """
+    requested_at = time.time()
+    data, error = json_object()
+    if error:
+        return error
+    pretrigger.start()
+    try:
+        offset = max(0.0, float(data.get('offset') or 0))
+        before = max(0.0, float(data.get('before') or 0))
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({"status": "error", "message": "offset and before must be numbers"}), 400
+    if (offset or before) and not PRETRIGGER_ENABLED:
+        return jsonify({"status": "error", "message": "The pre-trigger buffer is off (PRETRIGGER_ENABLED)"}), 409
+
+    # How far a buffered frame may be from the moment asked for
+    tolerance = max(0.5, 2.0 / PRETRIGGER_FPS)
+    if offset:
+        frame, shot_at = pretrigger.closest(requested_at - offset)
+        if frame is None or abs(shot_at - (requested_at - offset)) > tolerance:
+            return jsonify({"status": "error", "message": "Nothing buffered from that far back"}), 409
+    else:
+        success, frame = read_frame()
+        if not success:
+            return jsonify({"status": "error", "message": "Camera failed"}), 500
+        shot_at = requested_at
+
+    timestamp = datetime.fromtimestamp(shot_at).strftime('%Y%m%d_%H%M%S')
+    filename = f"shot_{timestamp}.jpg"
+    job_id, roi = submit_with_roi(frame, filename, roi=data.get('roi'), timestamp=shot_at)
+    if job_id is None:
+        return jsonify({"status": "error", "message": "Storage is busy, photo dropped"}), 503
+    result = {"status": "success", "filename": filename, "job_id": job_id,
+              "offset": round(requested_at - shot_at, 3)}
+    if roi is not None:
+        result["roi"] = roi
+
+    if before:
+        result["pre_trigger"] = []
+        earlier = pretrigger.select(shot_at - before, shot_at - 0.001)
+        result["pre_trigger_short"] = not earlier or earlier[0][1] - (shot_at - before) > tolerance
+        for i, (pre_frame, grabbed_at) in enumerate(earlier):
+            # Named and indexed by its own grab time so the gallery keeps it in order
+            pre_name = f"shot_{datetime.fromtimestamp(grabbed_at).strftime('%Y%m%d_%H%M%S')}_pre{i+1}.jpg"
+            pre_job = disk_writer.submit(pre_frame, pre_name, timestamp=grabbed_at)
+            if pre_job is not None:
+                result["pre_trigger"].append({"filename": pre_name, "job_id": pre_job,
+                                              "offset": round(requested_at - grabbed_at, 3)})
+    return jsonify(result)
+
+
+@app.route('/burst', methods=['POST'])
+def burst_capture():
+    """Take multiple photos in quick succession (grabbed first, saved in the background).
+
+    "before" (seconds) starts the burst with buffered frames from before
+    the request, spaced "delay" apart like the rest. "keep" (save only the
+    K sharpest frames) and "min_sharpness" (save only frames scoring at
+    least this) drop the blurry ones; every frame's score is returned.
+    """
+    data, error = json_object()
+    if error:
+        return error
+    count = data.get('count', 5)
+    delay = data.get('delay', 0.2)
+    before = data.get('before', 0)
+    keep = data.get('keep')
+    min_sharpness = data.get('min_sharpness')
+    pretrigger.start()
+    try:
+        count = max(1, min(int(count), BURST_MAX_FRAMES))
+        delay = max(0.0, min(float(delay), BURST_MAX_DELAY))
+        before = max(0.0, float(before or 0))
+        keep = int(keep) if keep is not None else None
+        min_sharpness = float(min_sharpness) if min_sharpness is not None else None
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({"status": "error",
+                        "message": "count, delay, before, keep and min_sharpness must be numbers"}), 400
+    if not math.isfinite(delay) or not math.isfinite(before):
+        return jsonify({"status": "error", "message": "delay and before must be finite"}), 400
+    if before and not PRETRIGGER_ENABLED:
+        return jsonify({"status": "error", "message": "The pre-trigger buffer is off (PRETRIGGER_ENABLED)"}), 409
+
+    earlier = []
+    if before:
+        now = time.time()
+        earlier = pretrigger.select(now - before, now, spacing=delay)
+    result = burst_engine.run(count, delay, earlier=earlier, keep=keep, min_sharpness=min_sharpness)
+    if not result["grabbed"]:
+        return jsonify({"status": "error", "message": "Camera failed"}), 500
+    result["status"] = "success"
+    return jsonify(result)
+
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    """Check whether a queued photo has been written to disk yet."""
+    info = disk_writer.job(job_id)
+    if info is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    info['job_id'] = job_id
+    return jsonify(info)
 
 
-# ============================================================
-# PHOTO CAPTURE - Take and save photos
-# ============================================================
+@app.route('/jobs')
+def job_queue():
+    """How the background disk writer is keeping up."""
+    return jsonify(disk_writer.stats())
 
-@app.route('/capture', methods=['POST'])
-def capture():
-    """Take a photo and save it."""
-    success, frame = read_frame()
-    if success:
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"shot_{timestamp}.jpg"
-        filepath = os.path.join(SAVE_DIR, filename)
-        cv2.imwrite(filepath, frame)
-        return jsonify({"status": "success", "filename": filename})
-    return jsonify({"status": "error", "message": "Camera failed"}), 500
 
+@app.route('/camera')
+def camera_health():
+    """Camera supervisor state, reconnects and how old the last good frame is."""
+    broadcaster.start()
+    return jsonify(broadcaster.health())
 
-@app.route('/burst', methods=['POST'])
-def burst_capture():
-    """Take multiple photos in quick succession."""
-    count = request.json.get('count', 5) if request.is_json else 5
-    delay = request.json.get('delay', 0.2) if request.is_json else 0.2
-    
-    saved_files = []
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    
-    for i in range(count):
-        success, frame = read_frame()
-        if success:
-            filename = f"burst_{timestamp}_{i+1}.jpg"
-            filepath = os.path.join(SAVE_DIR, filename)
-            cv2.imwrite(filepath, frame)
-            saved_files.append(filename)
-        time.sleep(delay)
-    
-    return jsonify({"status": "success", "files": saved_files, "count": len(saved_files)})
+
+@app.route('/pretrigger')
+def pretrigger_status():
+    """How much history the pre-trigger buffer is holding."""
+    pretrigger.start()
+    return jsonify(pretrigger.stats())
 
 
 # ============================================================
@@ -671,90 +3365,569 @@ def burst_capture():
 @app.route('/gallery')
 def gallery():
     """Show all captured photos."""
-    files = [f for f in os.listdir(SAVE_DIR) if f.endswith('.jpg')]
-    files.sort(reverse=True)  # Newest first
+    # Only the first page is rendered, the rest comes from /api/photos
+    photos, next_cursor = photo_index.page(limit=GALLERY_PAGE_SIZE)
     
-    # Calculate storage used
-    total_size = sum(os.path.getsize(os.path.join(SAVE_DIR, f)) for f in files)
+    # Storage used comes from the index, no need to stat every file
+    photo_count, total_size = photo_index.totals()
     size_mb = total_size / (1024 * 1024)
     
-    return render_template_string(GALLERY_TEMPLATE, files=files, size_mb=size_mb)
+    return gallery_page.render(photos=photos, next_cursor=next_cursor,
+                               photo_count=photo_count, size_mb=size_mb)
+
+
+def parse_time_arg(value):
+    """Turn a ?from= / ?to= value into a unix timestamp.
+
+    Accepts unix seconds, ISO dates ("2026-10-16" or "2026-10-16T21:30")
+    or our filename format ("20261016_213000").
+    """
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, '%Y%m%d_%H%M%S').timestamp()
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+@app.route('/api/photos')
+def api_photos():
+    """List photos as JSON, newest first, one page at a time."""
+    try:
+        limit = min(max(int(request.args.get('limit', GALLERY_PAGE_SIZE)), 1), 500)
+        start = parse_time_arg(request.args.get('from'))
+        end = parse_time_arg(request.args.get('to'))
+        photos, next_cursor = photo_index.page(
+            cursor=request.args.get('cursor') or None,
+            limit=limit,
+            kind=request.args.get('kind') or None,
+            start=start,
+            end=end)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Bad parameter: {e}"}), 400
+    
+    for photo in photos:
+        photo['url'] = f"/photos/{photo['filename']}"
+        photo['thumb_url'] = f"/thumbs/{photo['filename']}"
+        photo['captured_at'] = datetime.fromtimestamp(photo['timestamp']).isoformat()
+        photo['meta'] = json.loads(photo['meta']) if photo.get('meta') else None
+    return jsonify({"photos": photos, "next_cursor": next_cursor})
+
+
+# Browsers get a strong ETag made from the index row (size, time and
+# storage tier, so a photo recompressed in place gets a new one) plus a
+# PHOTO_CACHE_SECONDS max-age. A repeat gallery visit either doesn't ask
+# at all or gets a 304 that is answered from the index without touching
+# the SD card. Range requests and
+# Last-Modified come from send_from_directory, and in async server mode
+# the file body goes out with the kernel's sendfile.
+
+def photo_etag(info, variant=""):
+    """Strong ETag for a photo (or its thumbnail) from its index row."""
+    key = f"{variant}|{info['filename']}|{info['size']}|{info['timestamp']}|{info.get('tier', 0)}"
+    if variant == "thumb":
+        key += f"|{info['thumb']}"
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def send_photo(directory, filename, variant="", as_attachment=False):
+    """send_from_directory with index ETags, 304s and revalidated caching."""
+    info = photo_index.get(filename)
+    if info is None:
+        # Only indexed photos; the index and thumbs/ live in SAVE_DIR too
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    etag = photo_etag(info, variant)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+    else:
+        response = send_from_directory(directory, filename, as_attachment=as_attachment,
+                                       etag=etag, max_age=PHOTO_CACHE_SECONDS)
+    response.cache_control.public = True
+    response.cache_control.max_age = PHOTO_CACHE_SECONDS
+    return response
 
 
 @app.route('/photos/<filename>')
 def serve_photo(filename):
     """Serve a photo file."""
-    return send_from_directory(SAVE_DIR, filename)
+    return send_photo(SAVE_DIR, filename)
+
+
+@app.route('/thumbs/<filename>')
+def serve_thumbnail(filename):
+    """Serve a photo's thumbnail, making it first if it's missing."""
+    if not os.path.exists(os.path.join(THUMB_DIR, filename)):
+        if photo_index.get(filename) is None or not thumbnails.make(filename):
+            return jsonify({"status": "error", "message": "File not found"}), 404
+    thumbnails.touch(filename)
+    return send_photo(THUMB_DIR, filename, variant="thumb")
 
 
 @app.route('/download/<filename>')
 def download_photo(filename):
     """Download a photo file."""
-    return send_from_directory(SAVE_DIR, filename, as_attachment=True)
+    return send_photo(SAVE_DIR, filename, as_attachment=True)
 
 
 @app.route('/delete/<filename>', methods=['POST'])
 def delete_photo(filename):
     """Delete a single photo."""
-    filepath = os.path.join(SAVE_DIR, filename)
-    if os.path.exists(filepath):
-        os.remove(filepath)
+    if photo_index.get(filename) is not None:
+        remove_photo(filename)
         return jsonify({"status": "success"})
     return jsonify({"status": "error", "message": "File not found"}), 404
 
 
+# Held while a photo file is deleted, and while StorageTiers swaps a
+# recompressed file in, so a rewrite can't bring a deleted photo back
+photo_files_lock = threading.Lock()
+
+
 @app.route('/delete_all', methods=['POST'])
 def delete_all_photos():
     """Delete all photos (careful!)."""
-    files = [f for f in os.listdir(SAVE_DIR) if f.endswith('.jpg')]
-    for f in files:
-        os.remove(os.path.join(SAVE_DIR, f))
+    files = photo_index.filenames()
+    with photo_files_lock:
+        for f in files:
+            try:
+                os.remove(os.path.join(SAVE_DIR, f))
+            except FileNotFoundError:
+                pass
+    photo_index.clear()
+    thumbnails.remove_all()
     return jsonify({"status": "success", "deleted": len(files)})
 
 
+def remove_photo(filename):
+    """Delete a photo, its thumbnail and its index entry. Returns the bytes freed."""
+    with photo_files_lock:
+        try:
+            os.remove(os.path.join(SAVE_DIR, filename))
+        except FileNotFoundError:
+            pass
+    thumbnails.remove(filename)
+    return photo_index.remove(filename)
+
+
+# ============================================================
+# EXPORT - Download many photos as one ZIP
+# ============================================================
+# The ZIP is built on the fly while it's being sent: no temp file, and
+# only one small read buffer for the file data. Entries are "stored" (JPEGs don't
+# compress any further) and use data descriptors, so each CRC is worked
+# out while the file streams past. Because the layout is fixed before the
+# first byte goes out, we know the total size up front and can answer
+# HTTP Range requests to resume an interrupted download. That layout is
+# the one thing that grows with the selection: a short tuple per photo
+# (a couple of hundred bytes), read from the index in batches and capped
+# at the 65535 files a plain ZIP can hold.
+# While an archive is streaming its photos are pinned: the quota won't
+# delete them and recompression won't rewrite them. A photo that goes
+# missing anyway (deleted by hand) is sent as zeros so the download
+# still matches its Content-Length.
+
+ZIP_CHUNK = 64 * 1024
+
+
+class PhotoPins:
+    """Counts which photos are being streamed out so nothing deletes or rewrites them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    @contextmanager
+    def hold(self, filenames):
+        with self.lock:
+            for f in filenames:
+                self.counts[f] = self.counts.get(f, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                for f in filenames:
+                    self.counts[f] -= 1
+                    if not self.counts[f]:
+                        del self.counts[f]
+
+    def pinned(self, filename):
+        with self.lock:
+            return filename in self.counts
+
+
+export_pins = PhotoPins()
+
+class ZipStream:
+    """A stored (uncompressed) ZIP of photos that can be streamed from any offset."""
+
+    def __init__(self, photo_dir, photos):
+        """photos can be any iterable of index rows; only the layout of each is kept."""
+        self.photo_dir = photo_dir
+        self.crcs = {}               # entry number -> CRC-32, filled in as files stream past
+        self.entries = []            # (name bytes, size, dos time, dos date, local header offset)
+        offset = 0
+        for photo in photos:
+            name = photo['filename'].encode()
+            when = datetime.fromtimestamp(photo['timestamp'])
+            dos_time = (when.hour << 11) | (when.minute << 5) | (when.second // 2)
+            dos_date = (max(when.year - 1980, 0) << 9) | (when.month << 5) | when.day
+            self.entries.append((name, photo['size'], dos_time, dos_date, offset))
+            offset += 30 + len(name) + photo['size'] + 16
+            if len(self.entries) > 0xFFFF:
+                break  # Won't fit anyway (see fits_in_zip32), don't read the rest
+        self.central_offset = offset
+        self.central_size = sum(46 + len(e[0]) for e in self.entries)
+        self.total_size = offset + self.central_size + 22
+        # Same photos with the same sizes and times -> same bytes -> same ETag
+        digest = hashlib.sha1()
+        for name, size, dos_time, dos_date, _ in self.entries:
+            digest.update(name + struct.pack('<IHH', size, dos_time, dos_date))
+        self.etag = digest.hexdigest()
+
+    def fits_in_zip32(self):
+        """Plain ZIP tops out at 65535 files and 4 GB (no ZIP64 here)."""
+        return len(self.entries) <= 0xFFFF and self.total_size <= 0xFFFFFFFF
+
+    def _local_header(self, i):
+        name, _, dos_time, dos_date, _ = self.entries[i]
+        # Flag 0x08: CRC and sizes follow the data in a data descriptor
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x08, 0, dos_time, dos_date,
+                           0, 0, 0, len(name), 0) + name
+
+    def _crc(self, i):
+        """CRC of entry i, reading the file if it hasn't streamed past in full."""
+        if i not in self.crcs:
+            crc = 0
+            for chunk in self._read(i, 0, self.entries[i][1]):
+                crc = zlib.crc32(chunk, crc)
+            self.crcs[i] = crc
+        return self.crcs[i]
+
+    def _descriptor(self, i):
+        size = self.entries[i][1]
+        return struct.pack('<IIII', 0x08074b50, self._crc(i), size, size)
+
+    def _central_directory(self):
+        parts = []
+        for i, (name, size, dos_time, dos_date, offset) in enumerate(self.entries):
+            parts.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x08, 0,
+                                     dos_time, dos_date, self._crc(i), size, size,
+                                     len(name), 0, 0, 0, 0, 0, offset) + name)
+        parts.append(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                 self.central_size, self.central_offset, 0))
+        return b''.join(parts)
+
+    def _read(self, i, start, stop):
+        """File bytes [start, stop) of entry i, in chunks. Short or missing files are zero-padded."""
+        size = self.entries[i][1]
+        try:
+            f = open(os.path.join(self.photo_dir, self.entries[i][0].decode()), 'rb')
+        except FileNotFoundError:
+            f = io.BytesIO()  # Deleted since the layout was fixed; send zeros in its place
+        with f:
+            f.seek(start)
+            position = start
+            while position < stop:
+                chunk = f.read(min(ZIP_CHUNK, stop - position))
+                if not chunk:
+                    # The file shrank since it was indexed; keep the layout intact
+                    chunk = bytes(min(ZIP_CHUNK, stop - position, size - position))
+                position += len(chunk)
+                yield chunk
+
+    def generate(self, start=0, stop=None):
+        """Yield the archive's bytes from start up to (not including) stop."""
+        with export_pins.hold([e[0].decode() for e in self.entries]):
+            yield from self._generate(start, stop)
+
+    def _generate(self, start, stop):
+        if stop is None:
+            stop = self.total_size
+        for i, (name, size, _, _, offset) in enumerate(self.entries):
+            header_end = offset + 30 + len(name)
+            data_end = header_end + size
+            entry_end = data_end + 16
+            if entry_end <= start:
+                continue
+            if offset >= stop:
+                return
+            if start < header_end:
+                header = self._local_header(i)
+                yield header[max(start - offset, 0):stop - offset]
+            if start < data_end and stop > header_end:
+                first = max(start - header_end, 0)
+                last = min(stop, data_end) - header_end
+                whole_file = first == 0 and last == size
+                crc = 0
+                for chunk in self._read(i, first, last):
+                    if whole_file:
+                        crc = zlib.crc32(chunk, crc)
+                    yield chunk
+                if whole_file:
+                    self.crcs[i] = crc
+            if stop > data_end:
+                yield self._descriptor(i)[max(start - data_end, 0):stop - data_end]
+        if stop > self.central_offset:
+            tail = self._central_directory()
+            yield tail[max(start - self.central_offset, 0):stop - self.central_offset]
+
+
+def export_selection(params):
+    """Iterate over the photos to export from ?files=a,b / kind / from / to."""
+    files = params.get('files')
+    if files is not None and not isinstance(files, (str, list)):
+        raise ValueError("files must be a list of photo filenames or a comma-separated string")
+    if files:
+        if isinstance(files, str):
+            files = [f for f in files.split(',') if f]
+        photos = (photo_index.get(f) for f in files if isinstance(f, str))
+        return (p for p in photos if p is not None)
+    return photo_index.iter_photos(kind=params.get('kind') or None,
+                                   start=parse_time_arg(params.get('from')),
+                                   end=parse_time_arg(params.get('to')))
+
+
+@app.route('/export', methods=['GET', 'POST'])
+def export_photos():
+    """Download photos as one ZIP, streamed straight from disk.
+
+    Pick photos with files=a.jpg,b.jpg, or with kind / from / to (same
+    formats as /api/photos). Use GET if you want to be able to resume:
+    Range requests work as long as the selection hasn't changed. Memory
+    grows with the number of photos picked (see EXPORT), not their size.
+    """
+    params, error = json_object() if request.is_json else (request.args, None)
+    if error:
+        return error
+    try:
+        archive = ZipStream(SAVE_DIR, export_selection(params))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Bad parameter: {e}"}), 400
+    if not archive.entries:
+        return jsonify({"status": "error", "message": "No photos match"}), 404
+    
+    if not archive.fits_in_zip32():
+        return jsonify({"status": "error", "message": "Too many photos for one ZIP, pick a smaller range"}), 413
+    
+    headers = {
+        "Content-Disposition": f"attachment; filename=waldo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{archive.etag}"',
+    }
+    start, stop, status = 0, archive.total_size, 200
+    
+    # Resume support: honour Range unless If-Range says the selection changed
+    byte_range = request.range
+    if_range = request.if_range
+    unchanged = (if_range.etag is None and if_range.date is None) or if_range.etag == archive.etag
+    if byte_range is not None and unchanged:
+        span = byte_range.range_for_length(archive.total_size)
+        if span is None:
+            headers["Content-Range"] = f"bytes */{archive.total_size}"
+            return Response(status=416, headers=headers)
+        start, stop = span
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{archive.total_size}"
+    
+    headers["Content-Length"] = str(stop - start)
+    return Response(archive.generate(start, stop), status=status,
+                    mimetype='application/zip', headers=headers, direct_passthrough=True)
+
+
 # ============================================================
 # SYSTEM INFO - Check Pi status
 # ============================================================
 
+# A background sampler reads sysfs, /proc and the disk every
+# SAMPLE_INTERVAL seconds into a fixed-size ring buffer, so /system never
+# touches the filesystem on the request thread. /system returns the newest
+# sample and /system/history serves downsampled series for charts.
+
+def read_cpu_temp():
+    """CPU temperature in °C, or None if we can't read it."""
+    try:
+        with open(THERMAL_PATH, 'r') as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def read_memory():
+    """(used MB, total MB) from /proc/meminfo, or (None, None)."""
+    try:
+        fields = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                fields[name] = int(value.split()[0])  # kB
+        total = fields['MemTotal']
+        available = fields.get('MemAvailable', fields.get('MemFree', 0))
+        return (total - available) / 1024, total / 1024
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+
+class SystemSampler:
+    """Background thread that keeps the last SAMPLE_HISTORY system samples."""
+
+    def __init__(self):
+        self.samples = deque(maxlen=SAMPLE_HISTORY)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_cpu = None         # (busy, total) jiffies from the previous /proc/stat read
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+            self.thread.start()
+
+    def _cpu_percent(self):
+        """CPU busy % since the last sample (None on the first one)."""
+        try:
+            with open('/proc/stat') as f:
+                values = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+        total = sum(values)
+        previous, self.last_cpu = self.last_cpu, (total - idle, total)
+        if previous is None or total == previous[1]:
+            return None
+        return 100.0 * (total - idle - previous[0]) / (total - previous[1])
+
+    def sample(self):
+        """Take one sample now and add it to the history."""
+        entry = {"time": time.time(), "cpu_temp": read_cpu_temp(), "cpu_percent": self._cpu_percent()}
+        try:
+            entry["cpu_load"] = os.getloadavg()[0]
+        except OSError:
+            entry["cpu_load"] = None
+        entry["mem_used_mb"], entry["mem_total_mb"] = read_memory()
+        try:
+            entry["disk_total"], entry["disk_used"], entry["disk_free"] = shutil.disk_usage('/')
+        except OSError:
+            entry["disk_total"] = entry["disk_used"] = entry["disk_free"] = None
+        entry["photo_count"], entry["photos_bytes"] = photo_index.totals()
+        entry["camera_fps"] = round(broadcaster.fps, 2)
+        with stream_clients_lock:
+            clients = list(stream_clients.values())
+        entry["stream_clients"] = len(clients)
+        entry["stream_fps"] = round(sum(c.fps for c in clients), 2)
+        with self.lock:
+            self.samples.append(entry)
+        return entry
+
+    def latest(self):
+        """The newest sample (taking one if there isn't one yet)."""
+        with self.lock:
+            if self.samples:
+                return self.samples[-1]
+        return self.sample()
+
+    def history(self, seconds=None, points=120, fields=None):
+        """Samples from the last `seconds`, averaged down to at most `points` per series."""
+        with self.lock:
+            samples = list(self.samples)
+        if seconds is not None:
+            cutoff = time.time() - seconds
+            samples = [e for e in samples if e["time"] >= cutoff]
+        if fields is None:
+            fields = [k for k in (samples[0] if samples else {}) if k != "time"]
+        points = max(1, points)
+        step = max(1, -(-len(samples) // points))  # Ceiling division
+        times, series = [], {field: [] for field in fields}
+        for i in range(0, len(samples), step):
+            bucket = samples[i:i + step]
+            times.append(round(sum(e["time"] for e in bucket) / len(bucket), 1))
+            for field in fields:
+                values = [e.get(field) for e in bucket if e.get(field) is not None]
+                series[field].append(round(sum(values) / len(values), 2) if values else None)
+        return {"interval": SAMPLE_INTERVAL * step, "time": times, "series": series}
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"⚠️ System sample failed: {e}")
+            time.sleep(SAMPLE_INTERVAL)
+
+
+system_sampler = SystemSampler()
+
+
 @app.route('/system')
 def system_info():
-    """Get system stats (CPU temp, disk space, etc.)."""
+    """Get system stats (CPU temp, disk space, etc.) from the latest background sample."""
+    system_sampler.start()
+    sample = system_sampler.latest()
     info = {}
     
     # CPU Temperature
-    try:
-        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-            temp = int(f.read()) / 1000
-            info['cpu_temp'] = f"{temp:.1f}°C"
-    except:
-        info['cpu_temp'] = "Unknown"
+    temp = sample["cpu_temp"]
+    info['cpu_temp'] = f"{temp:.1f}°C" if temp is not None else "Unknown"
+    info['cpu_load'] = f"{sample['cpu_load']:.2f}" if sample['cpu_load'] is not None else "Unknown"
+    info['cpu_percent'] = f"{sample['cpu_percent']:.0f}%" if sample['cpu_percent'] is not None else "Unknown"
+    
+    # Memory
+    if sample['mem_total_mb']:
+        info['memory'] = f"{sample['mem_used_mb']:.0f} / {sample['mem_total_mb']:.0f} MB"
+    else:
+        info['memory'] = "Unknown"
     
     # Disk space
-    try:
-        total, used, free = shutil.disk_usage('/')
+    total, used, free = sample["disk_total"], sample["disk_used"], sample["disk_free"]
+    if total:
         info['disk_total'] = f"{total // (1024**3)} GB"
         info['disk_used'] = f"{used // (1024**3)} GB"
         info['disk_free'] = f"{free // (1024**3)} GB"
         info['disk_percent'] = f"{(used / total) * 100:.1f}%"
-    except:
+    else:
         info['disk_total'] = "Unknown"
     
     # Photo count and size
-    files = [f for f in os.listdir(SAVE_DIR) if f.endswith('.jpg')]
-    total_size = sum(os.path.getsize(os.path.join(SAVE_DIR, f)) for f in files)
-    info['photo_count'] = len(files)
-    info['photos_size'] = f"{total_size / (1024*1024):.1f} MB"
+    info['photo_count'] = sample["photo_count"]
+    info['photos_size'] = f"{sample['photos_bytes'] / (1024*1024):.1f} MB"
     
     # Auto-capture status
     info['auto_capture_interval'] = f"{AUTO_CAPTURE_INTERVAL} seconds"
+    info['camera_fps'] = round(sample["camera_fps"], 1)
+    info['camera_state'] = broadcaster.state
+    info['stream_clients'] = sample["stream_clients"]
+    info['stream_fps'] = sample["stream_fps"]
+    info['mjpeg_passthrough'] = MJPEG_PASSTHROUGH
+    info['governor_tier'] = governor.tier_name()
+    info['sampled_at'] = datetime.fromtimestamp(sample["time"]).isoformat(timespec='seconds')
     
     return jsonify(info)
 
 
+@app.route('/system/history')
+def system_history():
+    """Downsampled system stats for charts.
+
+    ?seconds=3600 limits how far back to go, ?points=120 caps the number
+    of points per series and ?fields=cpu_temp,cpu_load picks the series.
+    """
+    system_sampler.start()
+    fields = request.args.get('fields')
+    return jsonify(system_sampler.history(
+        seconds=request.args.get('seconds', type=float),
+        points=request.args.get('points', 120, type=int),
+        fields=fields.split(',') if fields else None))
+
+
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
     """View or update settings."""
-    global AUTO_CAPTURE_INTERVAL, STREAM_QUALITY
+    global AUTO_CAPTURE_INTERVAL, STREAM_QUALITY, CHANGE_DETECTION, CHANGE_THRESHOLD
     
     if request.method == 'POST':
         data = request.json
@@ -762,51 +3935,1128 @@ def settings():
             AUTO_CAPTURE_INTERVAL = int(data['auto_capture_interval'])
         if 'stream_quality' in data:
             STREAM_QUALITY = int(data['stream_quality'])
+        if 'change_detection' in data:
+            CHANGE_DETECTION = bool(data['change_detection'])
+        if 'change_threshold' in data:
+            CHANGE_THRESHOLD = float(data['change_threshold'])
         return jsonify({"status": "success"})
     
+    # With adaptive streaming each viewer gets its own size; report the biggest
+    width, height = (STREAM_PROFILES[-1][:2] if ADAPTIVE_STREAM else (STREAM_WIDTH, STREAM_HEIGHT))
     return jsonify({
         "auto_capture_interval": AUTO_CAPTURE_INTERVAL,
         "stream_quality": STREAM_QUALITY,
-        "stream_width": STREAM_WIDTH,
-        "stream_height": STREAM_HEIGHT
+        "stream_width": width,
+        "stream_height": height,
+        "adaptive_stream": ADAPTIVE_STREAM,
+        "change_detection": CHANGE_DETECTION,
+        "change_threshold": CHANGE_THRESHOLD
     })
 
 
+# ============================================================
+# GOVERNOR - Back off before the Pi throttles itself
+# ============================================================
+# A hot Pi Zero 2 W drops its clock hard, and then the stream stutters
+# and auto-capture slips. The governor checks the CPU temperature and
+# load every GOVERNOR_INTERVAL seconds and moves the whole pipeline
+# through GOVERNOR_TIERS: lower stream FPS, lower JPEG quality, smaller
+# stream size and fewer encodes at once. It jumps straight to a hotter
+# tier, but only steps back once things have stayed cooler (by the
+# hysteresis margins) for GOVERNOR_RECOVER_SECONDS.
+
+def read_load():
+    """1-minute load average per CPU core, or None."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return None
+
+
+class PerformanceGovernor:
+    """Picks a GOVERNOR_TIERS tier from temperature and load and enforces its limits.
+
+    temp_source / load_source are plain functions returning °C and load
+    per core (or None), so tests can swap in fake readings.
+    """
+
+    MAX_LOG = 100                    # Transitions kept for /governor
+
+    def __init__(self, temp_source=read_cpu_temp, load_source=read_load):
+        self.temp_source = temp_source
+        self.load_source = load_source
+        self.lock = threading.Lock()
+        self.slots = threading.Condition(self.lock)
+        self.tier = 0
+        self.forced = None           # Tier pinned through the API, or None
+        self.temp = None
+        self.load = None
+        self.cool_since = None
+        self.encoding = 0            # Encodes currently holding a slot
+        self.transitions = deque(maxlen=self.MAX_LOG)
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name="governor", daemon=True)
+            self.thread.start()
+
+    def tier_name(self):
+        return GOVERNOR_TIERS[self.tier][0]
+
+    def clamp(self, width, height, quality, fps):
+        """Limit a stream profile to what the current tier allows."""
+        _, _, _, level, max_fps, max_quality, _ = GOVERNOR_TIERS[self.tier]
+        max_width, max_height = STREAM_PROFILES[level][:2]
+        if width > max_width:
+            width, height = max_width, max_height
+        return width, height, min(quality, max_quality), min(fps, max_fps)
+
+    @contextmanager
+    def encode_slot(self):
+        """Hold one of the tier's encode slots while compressing a JPEG."""
+        with self.slots:
+            while True:
+                limit = GOVERNOR_TIERS[self.tier][6]
+                if limit is None or self.encoding < limit:
+                    break
+                self.slots.wait(1.0)
+            self.encoding += 1
+        try:
+            yield
+        finally:
+            with self.slots:
+                self.encoding -= 1
+                self.slots.notify()
+
+    def _hotter_tier(self, temp, load):
+        """Hottest tier whose temperature or load limit has been reached."""
+        target = 0
+        for i, (_, max_temp, max_load, *_) in enumerate(GOVERNOR_TIERS):
+            if ((max_temp is not None and temp is not None and temp >= max_temp)
+                    or (max_load is not None and load is not None and load >= max_load)):
+                target = i
+        return target
+
+    def _cooled_off(self, temp, load):
+        """True if we're comfortably below the current tier's limits."""
+        _, max_temp, max_load, *_ = GOVERNOR_TIERS[self.tier]
+        temp_ok = max_temp is None or temp is None or temp < max_temp - GOVERNOR_HYSTERESIS_C
+        load_ok = max_load is None or load is None or load < max_load - GOVERNOR_HYSTERESIS_LOAD
+        return temp_ok and load_ok
+
+    def check(self, now=None):
+        """Take a reading and change tier if needed. Returns the tier."""
+        now = time.time() if now is None else now
+        temp, load = self.temp_source(), self.load_source()
+        with self.lock:
+            self.temp, self.load = temp, load
+            if self.forced is not None:
+                target, reason = self.forced, "forced"
+            elif not GOVERNOR_ENABLED:
+                target, reason = 0, "disabled"
+            else:
+                target, reason = self._hotter_tier(temp, load), "limit reached"
+                if target < self.tier:
+                    # Only step back after staying cool for a while, one tier at a time
+                    if not self._cooled_off(temp, load):
+                        self.cool_since = None
+                        target = self.tier
+                    elif self.cool_since is None:
+                        self.cool_since = now
+                        target = self.tier
+                    elif now - self.cool_since < GOVERNOR_RECOVER_SECONDS:
+                        target = self.tier
+                    else:
+                        target, reason = self.tier - 1, "recovered"
+                else:
+                    self.cool_since = None
+            if target != self.tier:
+                self._set_tier(target, reason, now)
+            return self.tier
+
+    def _set_tier(self, tier, reason, now):
+        """Switch tiers (call with the lock held)."""
+        previous = self.tier
+        self.tier = tier
+        self.cool_since = None
+        self.transitions.append({
+            "time": datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+            "from": GOVERNOR_TIERS[previous][0],
+            "to": GOVERNOR_TIERS[tier][0],
+            "reason": reason,
+            "cpu_temp": self.temp,
+            "load": round(self.load, 2) if self.load is not None else None,
+        })
+        self.slots.notify_all()      # Encode limit may have gone up
+        icon = "🔥" if tier > previous else "❄️"
+        print(f"{icon} Governor: {GOVERNOR_TIERS[previous][0]} -> {GOVERNOR_TIERS[tier][0]} ({reason})")
+
+    def force(self, tier):
+        """Pin a tier (None to go back to automatic)."""
+        if tier is not None:
+            with self.lock:
+                self.forced = tier
+            self.check()
+            return
+        # Back to automatic: go straight to whatever the readings call for
+        temp, load = self.temp_source(), self.load_source()
+        with self.lock:
+            self.forced = None
+            self.temp, self.load = temp, load
+            target = self._hotter_tier(temp, load) if GOVERNOR_ENABLED else 0
+            if target != self.tier:
+                self._set_tier(target, "automatic", time.time())
+
+    def stats(self):
+        with self.lock:
+            name, max_temp, max_load, level, max_fps, max_quality, encodes = GOVERNOR_TIERS[self.tier]
+            width, height = STREAM_PROFILES[level][:2]
+            return {
+                "enabled": GOVERNOR_ENABLED,
+                "tier": self.tier,
+                "name": name,
+                "forced": self.forced is not None,
+                "cpu_temp": self.temp,
+                "load_per_core": round(self.load, 2) if self.load is not None else None,
+                "limits": {"max_width": width, "max_height": height, "max_fps": max_fps,
+                           "max_quality": max_quality, "max_encodes": encodes},
+                "encoding": self.encoding,
+                "tiers": [t[0] for t in GOVERNOR_TIERS],
+                "transitions": list(self.transitions),
+            }
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                print(f"⚠️ Governor check failed: {e}")
+            time.sleep(GOVERNOR_INTERVAL)
+
+
+governor = PerformanceGovernor()
+
+
+@app.route('/governor', methods=['GET', 'POST'])
+def governor_status():
+    """Current tier, its limits and the transition log.
+
+    POST {"tier": N} pins a tier (by number or name), {"tier": null} goes
+    back to automatic.
+    """
+    governor.start()
+    if request.method == 'POST':
+        data, error = json_object()
+        if error:
+            return error
+        tier = data.get('tier')
+        names = [t[0] for t in GOVERNOR_TIERS]
+        if tier in names:
+            tier = names.index(tier)
+        if tier is not None and (isinstance(tier, bool) or not isinstance(tier, int)
+                                 or not 0 <= tier < len(GOVERNOR_TIERS)):
+            return jsonify({"status": "error", "message": f"Unknown tier: {tier}"}), 400
+        governor.force(tier)
+    return jsonify(governor.stats())
+
+
 # ============================================================
 # AUTO CAPTURE - Background photo capture
 # ============================================================
 
+class ChangeDetector:
+    """Compares frames to the last saved one on a tiny grayscale copy."""
+
+    SIZE = (160, 90)                 # Small enough to be nearly free, big enough to see the moon move
+
+    def __init__(self):
+        self.last_saved = None
+        self.last_score = None
+        self.checked = 0
+        self.skipped = 0
+        self.saved = 0
+        self.extra = 0
+
+    def signature(self, frame):
+        source = frame.reduced(self.SIZE[0]) if isinstance(frame, Frame) else frame
+        small = cv2.resize(source, self.SIZE, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.int16)
+
+    def score(self, frame):
+        """Mean absolute difference from the last saved frame (None if there isn't one)."""
+        self.checked += 1
+        if self.last_saved is None:
+            self.last_score = None
+        else:
+            self.last_score = float(np.abs(self.signature(frame) - self.last_saved).mean())
+        return self.last_score
+
+    def mark_saved(self, frame, extra=False):
+        self.last_saved = self.signature(frame)
+        if extra:
+            self.extra += 1
+        else:
+            self.saved += 1
+
+    def stats(self):
+        return {
+            "enabled": CHANGE_DETECTION,
+            "threshold": CHANGE_THRESHOLD,
+            "burst_threshold": CHANGE_BURST_THRESHOLD,
+            "checked": self.checked,
+            "skipped": self.skipped,
+            "saved": self.saved,
+            "extra_saved": self.extra,
+            "last_score": None if self.last_score is None else round(self.last_score, 2),
+        }
+
+
+change_detector = ChangeDetector()
+
+def save_auto_photo(frame, suffix=""):
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = f"auto_{timestamp}{suffix}.jpg"
+    
+    # Clean up old photos (if we're using too much storage) once it's saved
+    submit_with_roi(frame, filename, on_done=lambda _: cleanup_old_photos())
+
 def periodic_capture():
     """Automatically capture photos at regular intervals."""
+    last_run = None
     while True:
+        now = time.time()
+        if last_run is not None:
+            autocapture_drift_seconds.observe(max(0.0, now - last_run - AUTO_CAPTURE_INTERVAL))
+        last_run = now
+        
         success, frame = read_frame()
         if success:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"auto_{timestamp}.jpg"
-            filepath = os.path.join(SAVE_DIR, filename)
-            cv2.imwrite(filepath, frame)
-            
-            # Clean up old photos if we're using too much storage
-            cleanup_old_photos()
+            score = change_detector.score(frame) if CHANGE_DETECTION else None
+            if score is not None and score < CHANGE_THRESHOLD:
+                change_detector.skipped += 1  # Looks the same as last time
+            else:
+                save_auto_photo(frame)
+                change_detector.mark_saved(frame)
+                if TIMELAPSE_ENABLED:
+                    try:
+                        timelapse.add(frame)
+                    except Exception as e:
+                        print(f"⚠️ Time-lapse frame failed: {e}")
+                
+                # Something big happened, grab a few more while it lasts
+                if score is not None and score >= CHANGE_BURST_THRESHOLD:
+                    for i in range(CHANGE_BURST_FRAMES):
+                        time.sleep(CHANGE_BURST_SPACING)
+                        success, frame = read_frame()
+                        if success:
+                            save_auto_photo(frame, f"_x{i+1}")
+                            change_detector.mark_saved(frame, extra=True)
         
         time.sleep(AUTO_CAPTURE_INTERVAL)
 
 
+@app.route('/timelapse')
+def timelapse_list():
+    """List the time-lapse videos on the Pi."""
+    return jsonify({"videos": timelapse.videos(), "enabled": TIMELAPSE_ENABLED})
+
+
+@app.route('/timelapse/build', methods=['POST'])
+def timelapse_build():
+    """Stitch a range of photos into a video in the background.
+
+    JSON body: from, to (same formats as /api/photos), kind (default
+    "auto"), fps and width (both optional).
+    """
+    data, error = json_object()
+    if error:
+        return error
+    try:
+        start = parse_time_arg(data.get('from'))
+        end = parse_time_arg(data.get('to'))
+        fps = float(data.get('fps', TIMELAPSE_FPS))
+        width = int(data['width']) if data.get('width') else None
+    except (TypeError, ValueError, OverflowError) as e:
+        return jsonify({"status": "error", "message": f"Bad parameter: {e}"}), 400
+    if not math.isfinite(fps) or not 0 < fps <= 120:
+        return jsonify({"status": "error", "message": "fps must be above 0 and at most 120"}), 400
+    if width is not None and not 16 <= width <= 8192:
+        return jsonify({"status": "error", "message": "width must be between 16 and 8192"}), 400
+    name = timelapse.start_build(kind=data.get('kind', 'auto'), start=start, end=end, fps=fps, width=width)
+    return jsonify({"status": "success", "filename": name, "url": f"/timelapse/{name}"})
+
+
+@app.route('/timelapse/<filename>')
+def timelapse_download(filename):
+    """Download a time-lapse video."""
+    return send_from_directory(TIMELAPSE_DIR, filename, as_attachment=True)
+
+
+@app.route('/timelapse/delete_all', methods=['POST'])
+def timelapse_delete_all():
+    """Delete every finished time-lapse video (photos are left alone)."""
+    return jsonify({"status": "success", "deleted": timelapse.remove_all()})
+
+
+@app.route('/timelapse/<filename>/delete', methods=['POST'])
+def timelapse_delete(filename):
+    """Delete a time-lapse video (not one that's still being recorded or built)."""
+    if timelapse.remove(filename):
+        return jsonify({"status": "success"})
+    return jsonify({"status": "error", "message": "File not found or still being written"}), 404
+
+
+@app.route('/stack', methods=['POST'])
+def stack_start():
+    """Stack a burst (or the last few camera frames) into one low-noise photo.
+
+    JSON body: burst (a burst name like burst_20260101_203000, or any of
+    its files), files (a list of photos) or frames (how many camera
+    frames to stack: the most recent ones from the pre-trigger buffer
+    when PRETRIGGER_ENABLED, otherwise the next ones the camera grabs,
+    or new frames for whatever the buffer doesn't hold); method ("mean", "median" or "sigma"), sigma and
+    align (default true) are optional.
+    """
+    data, error = json_object()
+    if error:
+        return error
+    files = data.get('files')
+    if files is not None:
+        if not isinstance(files, list):
+            return jsonify({"status": "error", "message": "files must be a list of photo filenames"}), 400
+        # Only photos we know about, so a path can't reach outside SAVE_DIR
+        files = [f for f in files if isinstance(f, str) and photo_index.get(f) is not None]
+        if not files:
+            return jsonify({"status": "error", "message": "None of those photos exist"}), 404
+    if data.get('burst'):
+        files = stacker.burst_files(data['burst'])
+        if not files:
+            return jsonify({"status": "error", "message": "No photos found for that burst"}), 404
+    try:
+        name = stacker.start(files=files, count=data.get('frames', 10),
+                             method=data.get('method', STACK_METHOD),
+                             sigma=float(data.get('sigma', STACK_SIGMA)),
+                             align=bool(data.get('align', True)))
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"Bad parameter: {e}"}), 400
+    return jsonify({"status": "success", "filename": name, "url": f"/stack/{name}"})
+
+
+@app.route('/stack/<filename>')
+def stack_status(filename):
+    """Progress of a stack (and its frame shifts once it's done)."""
+    info = stacker.builds.get(filename)
+    if info is None:
+        return jsonify({"status": "error", "message": "Unknown stack"}), 404
+    return jsonify(dict(info, filename=filename, photo=f"/photos/{filename}"))
+
+
+@app.route('/autocapture')
+def autocapture_stats():
+    """How many auto-captures change detection saved vs skipped."""
+    return jsonify(change_detector.stats())
+
+
 def cleanup_old_photos():
     """Delete oldest photos if storage exceeds limit."""
-    files = [f for f in os.listdir(SAVE_DIR) if f.endswith('.jpg')]
-    files.sort()  # Oldest first
-    
-    total_size = sum(os.path.getsize(os.path.join(SAVE_DIR, f)) for f in files)
-    max_bytes = MAX_STORAGE_MB * 1024 * 1024
-    
-    # Delete oldest files until we're under the limit
-    while total_size > max_bytes and len(files) > 10:
-        oldest = files.pop(0)
-        filepath = os.path.join(SAVE_DIR, oldest)
-        file_size = os.path.getsize(filepath)
-        os.remove(filepath)
-        total_size -= file_size
+    return storage_quota.enforce()
+
+
+# ============================================================
+# STORAGE QUOTA - Keep the SD card from filling up
+# ============================================================
+# Keeps a running byte total per kind (shot / burst / auto) and a heap of
+# photos per kind ordered oldest first, all fed by the photo index on
+# every add and delete. Checking whether anything needs deleting is O(1),
+# and deleting only costs the files actually removed. Deletion starts
+# above the high watermark and runs down to the low one, so it happens in
+# batches instead of after every single capture.
+
+class StorageQuota:
+    """Running totals + oldest-first heaps that decide which photos to delete."""
+
+    def __init__(self, index):
+        self.index = index
+        self.lock = threading.RLock()    # remove_photo() calls back into photo_removed()
+        self.photos = {}                 # filename -> (kind, timestamp, size)
+        self.heaps = {}                  # kind -> [(timestamp, filename), ...] (may hold stale entries)
+        self.kind_bytes = {}
+        self.kind_count = {}
+        self.total_bytes = 0
+        self.evicted = {}                # kind -> photos deleted by the quota
+        self.evicted_bytes = 0
+        for filename, kind, timestamp, size in index.rows():
+            self.photo_added(filename, kind, timestamp, size)
+        index.listeners.append(self)
+
+    # --- Fed by the photo index ---
+
+    def photo_added(self, filename, kind, timestamp, size):
+        with self.lock:
+            old = self.photos.get(filename)
+            if old is not None:
+                self.kind_bytes[old[0]] -= old[2]
+                self.kind_count[old[0]] -= 1
+                self.total_bytes -= old[2]
+            self.photos[filename] = (kind, timestamp, size)
+            self.kind_bytes[kind] = self.kind_bytes.get(kind, 0) + size
+            self.kind_count[kind] = self.kind_count.get(kind, 0) + 1
+            self.total_bytes += size
+            if old is None or old[:2] != (kind, timestamp):  # A size change keeps its heap entry
+                heapq.heappush(self.heaps.setdefault(kind, []), (timestamp, filename))
+
+    def photo_removed(self, filename):
+        with self.lock:
+            old = self.photos.pop(filename, None)
+            if old is None:
+                return
+            kind, _, size = old
+            self.kind_bytes[kind] -= size
+            self.kind_count[kind] -= 1
+            self.total_bytes -= size
+            # The heap entry is left behind and skipped later. Rebuild the
+            # heap if lots of those have piled up (e.g. manual deletes).
+            heap = self.heaps[kind]
+            if len(heap) > 64 and len(heap) > 2 * self.kind_count[kind]:
+                self.heaps[kind] = [(t, f) for t, f in heap
+                                    if self.photos.get(f, (None, None))[:2] == (kind, t)]
+                heapq.heapify(self.heaps[kind])
+
+    def photos_cleared(self):
+        with self.lock:
+            self.photos.clear()
+            self.heaps.clear()
+            self.kind_bytes.clear()
+            self.kind_count.clear()
+            self.total_bytes = 0
+
+    # --- Deciding what to delete ---
+
+    def _oldest(self, kind):
+        """Oldest live (timestamp, filename) of a kind, dropping stale heap entries."""
+        heap = self.heaps.get(kind)
+        while heap:
+            timestamp, filename = heap[0]
+            if self.photos.get(filename, (None, None))[:2] == (kind, timestamp):
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def _next_victim(self, kinds):
+        """The photo to delete next among kinds, weighting age by KIND_KEEP_FACTOR."""
+        now = time.time()
+        best, best_age = None, None
+        for kind in kinds:
+            oldest = self._oldest(kind)
+            if oldest is None:
+                continue
+            age = (now - oldest[0]) / KIND_KEEP_FACTOR.get(kind, 1)
+            if best is None or age > best_age:
+                best, best_age = oldest[1], age
+        return best
+
+    def _delete_down_to(self, kinds, used, low_bytes):
+        """Delete photos of the given kinds until used() is at or below low_bytes."""
+        deleted = 0
+        held = []                    # Heap entries of photos being exported, put back afterwards
+        while used() > low_bytes and len(self.photos) > MIN_PHOTOS_KEPT:
+            victim = self._next_victim(kinds)
+            if victim is None:
+                break
+            kind = self.photos[victim][0]
+            if export_pins.pinned(victim):
+                held.append((kind, heapq.heappop(self.heaps[kind])))  # It's the top of its heap
+                continue
+            size = self.photos[victim][2]
+            remove_photo(victim)
+            self.photo_removed(victim)  # In case it wasn't in the index any more (no-op otherwise)
+            storage_tiers.photo_removed(victim)
+            self.evicted_bytes += size
+            self.evicted[kind] = self.evicted.get(kind, 0) + 1
+            deleted += 1
+        for kind, entry in held:
+            heapq.heappush(self.heaps[kind], entry)
+        return deleted
+
+    def over_limits(self, fraction=STORAGE_HIGH_WATERMARK):
+        """[(kinds, used(), low bytes, high bytes), ...] for every limit over fraction of itself.
+
+        Per-kind limits come first, then the overall limit across every kind.
+        """
+        mb = 1024 * 1024
+        over = []
+        with self.lock:
+            for kind, quota_mb in KIND_QUOTA_MB.items():
+                if quota_mb is not None and self.kind_bytes.get(kind, 0) > quota_mb * mb * fraction:
+                    over.append(([kind], lambda kind=kind: self.kind_bytes.get(kind, 0),
+                                 quota_mb * mb * STORAGE_LOW_WATERMARK, quota_mb * mb * STORAGE_HIGH_WATERMARK))
+            if self.total_bytes > MAX_STORAGE_MB * mb * fraction:
+                over.append((list(self.heaps), lambda: self.total_bytes,
+                             MAX_STORAGE_MB * mb * STORAGE_LOW_WATERMARK, MAX_STORAGE_MB * mb * STORAGE_HIGH_WATERMARK))
+        return over
+
+    def enforce(self):
+        """Delete old photos if any limit is over its high watermark. Returns how many.
+
+        Nearing a limit wakes the recompression thread (see STORAGE TIERS).
+        Re-encoding never happens here, on the thread that just saved a
+        photo: past a limit, if that thread can squeeze right now only
+        enough is deleted to get back under the limit and it squeezes the
+        rest of the way down. Otherwise deletion goes to the low watermark.
+        """
+        deleted = 0
+        with self.lock:
+            for kinds, used, low_bytes, high_bytes in self.over_limits(min(RECOMPRESS_SQUEEZE_AT,
+                                                                           STORAGE_HIGH_WATERMARK)):
+                if used() <= low_bytes:
+                    continue  # An earlier limit may have freed enough already
+                squeezing = storage_tiers.can_squeeze(kinds)
+                if used() > high_bytes:
+                    deleted += self._delete_down_to(kinds, used, high_bytes if squeezing else low_bytes)
+        return deleted
+
+    def stats(self):
+        mb = 1024 * 1024
+        with self.lock:
+            return {
+                "total_mb": round(self.total_bytes / mb, 2),
+                "max_mb": MAX_STORAGE_MB,
+                "high_watermark": STORAGE_HIGH_WATERMARK,
+                "low_watermark": STORAGE_LOW_WATERMARK,
+                "kinds": {kind: {"count": self.kind_count.get(kind, 0),
+                                 "mb": round(self.kind_bytes.get(kind, 0) / mb, 2),
+                                 "quota_mb": KIND_QUOTA_MB.get(kind),
+                                 "keep_factor": KIND_KEEP_FACTOR.get(kind, 1),
+                                 "evicted": self.evicted.get(kind, 0)}
+                          for kind in sorted(set(self.kind_bytes) | set(KIND_QUOTA_MB))},
+                "evicted_mb": round(self.evicted_bytes / mb, 2),
+            }
+
+
+storage_quota = StorageQuota(photo_index)
+
+
+# ============================================================
+# STORAGE TIERS - Keep more history at lower quality
+# ============================================================
+# Instead of deleting the oldest photos as soon as MAX_STORAGE_MB is hit,
+# photos are re-encoded in place as they age: lower JPEG quality first,
+# then a smaller size (RECOMPRESS_TIERS). A low-priority background
+# thread does this whenever the Pi is idle and cool. Once the quota is
+# past RECOMPRESS_SQUEEZE_AT of a limit it wakes that thread, which pushes
+# the photos the quota would delete first straight to the last tier
+# (RECOMPRESS_BATCH at a time). The limit itself stays hard: saving a
+# photo never waits on a re-encode, so the quota deletes just enough to
+# get back under it while that thread squeezes the rest of the way down,
+# and when the thread can't run (a hot or busy Pi) the quota deletes as
+# if there were no tiers. Photos the quota deletes are dropped from the
+# squeeze and from what the thread remembers. Filenames stay the same;
+# the index and quota just see smaller sizes. (Everything stays JPEG:
+# gallery links, exports and downloads all expect .jpg.)
+
+class StorageTiers:
+    """Re-encodes aging photos to cheaper RECOMPRESS_TIERS and counts the bytes saved."""
+
+    def __init__(self, index, save_dir):
+        self.index = index
+        self.save_dir = save_dir
+        self.lock = threading.Lock()
+        self.busy = set()            # Filenames being rewritten right now
+        self.settled = {}            # filename -> tier it couldn't be made smaller for (not retried)
+        self.recompressed = {}       # tier -> photos re-encoded into it since startup
+        self.reclaimed = {}          # tier -> bytes saved since startup
+        self.wake = threading.Event()
+        self.thread = None
+        index.listeners.append(self)
+
+    # --- Fed by the photo index ---
+
+    def photo_added(self, filename, kind, timestamp, size):
+        pass
+
+    def photo_removed(self, filename):
+        with self.lock:
+            self.settled.pop(filename, None)
+
+    def photos_cleared(self):
+        with self.lock:
+            self.settled.clear()
+
+    def start(self):
+        if not RECOMPRESS_ENABLED or not RECOMPRESS_TIERS:
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name="storage-tiers", daemon=True)
+            self.thread.start()
+
+    def recompress(self, filename, tier):
+        """Rewrite one photo at RECOMPRESS_TIERS[tier - 1]. Returns the bytes saved."""
+        with self.lock:
+            if filename in self.busy or export_pins.pinned(filename):
+                return 0  # Being exported, try again on a later pass
+            self.busy.add(filename)
+        try:
+            _, _, quality, max_width = RECOMPRESS_TIERS[tier - 1]
+            filepath = os.path.join(self.save_dir, filename)
+            try:
+                with open(filepath, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return 0  # Deleted since it was picked
+            flags = cv2.IMREAD_COLOR
+            width = _jpeg_dimensions(io.BytesIO(data))[0] or 0
+            if max_width and width // 2 >= max_width:
+                flags = cv2.IMREAD_REDUCED_COLOR_2  # Half-size decode is cheaper and still big enough
+            with governor.encode_slot():
+                pixels = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+                if pixels is None:
+                    raise ValueError("not a readable JPEG")
+                if max_width and pixels.shape[1] > max_width:
+                    height = max(1, round(pixels.shape[0] * max_width / pixels.shape[1]))
+                    pixels = cv2.resize(pixels, (max_width, height), interpolation=cv2.INTER_AREA)
+                ok, buffer = cv2.imencode('.jpg', pixels, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not ok:
+                raise ValueError("JPEG encode failed")
+            if len(buffer) >= len(data):
+                # Already smaller than this tier would make it: leave the file
+                # (and its index row) alone, and don't try it again
+                with self.lock:
+                    self.settled[filename] = tier
+                return 0
+            temp = filepath + ".tmp"
+            with open(temp, 'wb') as f:
+                f.write(buffer.tobytes())
+            with photo_files_lock:
+                if not os.path.exists(filepath) or export_pins.pinned(filename):
+                    os.remove(temp)  # Deleted, or an export started, while we were busy
+                    return 0
+                os.replace(temp, filepath)
+            self.index.update_file(filename, len(buffer), pixels.shape[1], pixels.shape[0], tier)
+            saved = len(data) - len(buffer)
+            with self.lock:
+                self.recompressed[tier] = self.recompressed.get(tier, 0) + 1
+                self.reclaimed[tier] = self.reclaimed.get(tier, 0) + saved
+            return saved
+        except Exception as e:
+            print(f"⚠️ Couldn't recompress {filename}: {e}")
+            with self.lock:
+                self.settled[filename] = tier  # Don't retry forever
+            return 0
+        finally:
+            with self.lock:
+                self.busy.discard(filename)
+
+    def _candidates(self, tier, before, kinds, limit, weighted=False):
+        """tier_candidates() minus photos that are being exported or were already tried."""
+        with self.lock:
+            extra = len(self.settled)
+        rows = self.index.tier_candidates(tier, before, kinds, limit + extra, weighted)
+        with self.lock:
+            rows = [(f, t) for f, t in rows if self.settled.get(f, 0) < tier and not export_pins.pinned(f)]
+        return rows[:limit]
+
+    def can_squeeze(self, kinds):
+        """Called by the quota: True (and wake the thread) if it can squeeze photos of kinds right now."""
+        if not RECOMPRESS_ENABLED or not RECOMPRESS_TIERS:
+            return False
+        if self.thread is None or not self.thread.is_alive() or not self._idle():
+            return False
+        if not self._candidates(len(RECOMPRESS_TIERS), time.time(), kinds, 1):
+            return False
+        self.wake.set()
+        return True
+
+    def squeeze(self):
+        """Push photos to the last tier for every limit past RECOMPRESS_SQUEEZE_AT. Returns how many.
+
+        Photos go in the order the quota would delete them (age weighted
+        by KIND_KEEP_FACTOR), so fresh shots are the last to be touched.
+        """
+        done = 0
+        last = len(RECOMPRESS_TIERS)
+        for kinds, used, low_bytes, _ in storage_quota.over_limits(RECOMPRESS_SQUEEZE_AT):
+            for filename, _ in self._candidates(last, time.time(), kinds, RECOMPRESS_BATCH - done, weighted=True):
+                if used() <= low_bytes or not self._idle():
+                    break
+                if filename not in storage_quota.photos:
+                    continue  # Deleted since the candidates were listed
+                self.recompress(filename, last)
+                done += 1
+            if done >= RECOMPRESS_BATCH:
+                break
+        return done
+
+    def _idle(self):
+        load = read_load()
+        return governor.tier == 0 and (load is None or load < RECOMPRESS_MAX_LOAD)
+
+    def run_once(self):
+        """One background pass: move photos that are old enough into their tier. Returns how many."""
+        done = 0
+        now = time.time()
+        kinds = set(KIND_KEEP_FACTOR) | {"other"}
+        # Deepest tier first, so a very old photo goes straight to its final tier
+        for tier in range(len(RECOMPRESS_TIERS), 0, -1):
+            age = RECOMPRESS_TIERS[tier - 1][1] * 86400
+            for kind in kinds:
+                cutoff = now - age * KIND_KEEP_FACTOR.get(kind, 1)
+                for filename, _ in self._candidates(tier, cutoff, [kind], RECOMPRESS_BATCH - done):
+                    if not self._idle():
+                        return done
+                    self.recompress(filename, tier)
+                    done += 1
+                if done >= RECOMPRESS_BATCH:
+                    return done
+        return done
+
+    def stats(self):
+        totals = self.index.tier_totals()
+        mb = 1024 * 1024
+        tiers = [("original", None, None, None)] + list(RECOMPRESS_TIERS)
+        with self.lock:
+            return {
+                "enabled": RECOMPRESS_ENABLED,
+                "tiers": [{"tier": i, "name": name, "age_days": age, "quality": quality, "max_width": width,
+                           "photos": totals.get(i, (0, 0))[0],
+                           "mb": round((totals.get(i, (0, 0))[1] or 0) / mb, 2),
+                           "recompressed": self.recompressed.get(i, 0),
+                           "reclaimed_mb": round(self.reclaimed.get(i, 0) / mb, 2)}
+                          for i, (name, age, quality, width) in enumerate(tiers)],
+                "reclaimed_mb": round(sum(self.reclaimed.values()) / mb, 2),
+            }
+
+    def _run(self):
+        try:
+            # Lowest CPU priority for this thread only (Linux)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            self.wake.wait(RECOMPRESS_INTERVAL)
+            self.wake.clear()
+            if not self._idle():
+                continue
+            try:
+                # Squeezing for the quota comes before the age-based tiers
+                squeezed = self.squeeze()
+                if squeezed >= RECOMPRESS_BATCH or self.run_once() >= RECOMPRESS_BATCH:
+                    self.wake.set()  # More to do, keep going while it's quiet
+            except Exception as e:
+                print(f"⚠️ Recompression pass failed: {e}")
+
+
+storage_tiers = StorageTiers(photo_index, SAVE_DIR)
+
+
+@app.route('/storage')
+def storage_info():
+    """Storage used per kind, what the quota has deleted and what recompression has saved."""
+    storage_tiers.start()
+    info = storage_quota.stats()
+    info["recompression"] = storage_tiers.stats()
+    info["timelapse"] = {"mb": round(timelapse.total_bytes() / 1024 / 1024, 2),
+                         "max_mb": TIMELAPSE_MAX_MB}
+    return jsonify(info)
+
+
+# ============================================================
+# METRICS ENDPOINT
+# ============================================================
+
+def stream_client_values(field):
+    with stream_clients_lock:
+        clients = list(stream_clients.values())
+    return [({"client": c.id, "remote_addr": c.remote_addr}, getattr(c, field)) for c in clients]
+
+metrics.gauge("waldo_camera_fps", "Camera frames read per second", lambda: round(broadcaster.fps, 2))
+metrics.gauge("waldo_camera_up", "1 while the camera is delivering frames", lambda: int(broadcaster.state == "healthy"))
+metrics.gauge("waldo_camera_reconnects_total", "Times the supervisor gave up on the camera and reopened it",
+              lambda: broadcaster.reconnects, kind="counter")
+metrics.gauge("waldo_stream_clients", "Viewers currently watching /video", lambda: len(stream_clients))
+metrics.gauge("waldo_stream_client_fps", "Frames per second sent to each viewer",
+              lambda: stream_client_values("fps"))
+metrics.gauge("waldo_stream_client_bytes_sent", "Bytes sent to each viewer so far",
+              lambda: stream_client_values("bytes_sent"))
+metrics.gauge("waldo_stream_encodes_total", "Stream frames encoded (shared by all viewers)",
+              lambda: stream_encoder.encodes, kind="counter")
+metrics.gauge("waldo_stream_cache_hits_total", "Stream frames served from the encode cache",
+              lambda: stream_encoder.cache_hits, kind="counter")
+metrics.gauge("waldo_writer_queue_depth", "Photos waiting for the disk writer", lambda: disk_writer.jobs.qsize())
+metrics.gauge("waldo_pretrigger_bytes", "Memory used by the pre-trigger buffer", lambda: pretrigger.bytes)
+metrics.gauge("waldo_governor_tier", "Current governor tier (0 = normal)", lambda: governor.tier)
+metrics.gauge("waldo_photos", "Photos in the index", lambda: photo_index.totals()[0])
+metrics.gauge("waldo_photos_bytes", "Bytes used by photos", lambda: photo_index.totals()[1])
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Counters and histograms in Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# ============================================================
+# ASYNC SERVER - Lots of viewers without a thread each
+# ============================================================
+# With app.run(threaded=True) every open /video connection keeps an OS
+# thread (and its stack) alive for as long as someone is watching, which
+# is what ran the Pi out of memory with 20+ phones on the stream. With
+# SERVER_MODE = "async", /video is served from an asyncio event loop
+# instead: a viewer costs one coroutine, and waiting for frames or for a
+# slow phone to drain its socket doesn't hold a thread. Encoding runs on
+# a small thread pool (and only once per frame, see STREAM ENCODER).
+# Every other route is handed to the normal Flask app on that same pool,
+# so nothing else changes. Connections are closed after each response.
+
+class SendfileWrapper:
+    """wsgi.file_wrapper that lets AsyncServer send the file with sendfile()."""
+
+    def __init__(self, file, buffer_size=8192):
+        self.file = file
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.file.read(self.buffer_size)
+        if not data:
+            raise StopIteration()
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def sendfile_span(result):
+    """(file, offset, count) if a WSGI result is just a (range of a) file, else None."""
+    if isinstance(result, SendfileWrapper):
+        return result.file, 0, None
+    # werkzeug wraps the file like this for Range requests
+    inner = getattr(result, 'iterable', None)
+    if isinstance(inner, SendfileWrapper) and hasattr(result, 'start_byte'):
+        return inner.file, result.start_byte, result.byte_range
+    return None
+
+
+class AsyncServer:
+    """Minimal HTTP/1.1 server: /video on the event loop, the rest via WSGI."""
+
+    HEADER_TIMEOUT = 30              # Seconds a client gets to send its request headers
+    MAX_HEADER_BYTES = 65536
+
+    def __init__(self, wsgi_app, frames, workers=ASYNC_WORKER_THREADS):
+        self.wsgi_app = wsgi_app
+        self.frames = frames
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="async-worker")
+        self.loop = None
+        self.new_frame = None        # asyncio.Event, replaced after every frame
+        self.port = None
+        self.ready = threading.Event()
+
+    def frame_published(self, seq):
+        """Called from the grabber thread for every frame."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self.new_frame.set()
+        self.new_frame = asyncio.Event()
+
+    async def next_frame(self, last_seq, timeout=2.0):
+        """Async wait_for_frame_timed: (seq, frame, grabbed_at), frame None on timeout."""
+        with self.frames.condition:
+            if self.frames.seq > last_seq:
+                return self.frames.seq, self.frames.frame, self.frames.timestamp
+        event = self.new_frame
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return last_seq, None, None
+        with self.frames.condition:
+            return self.frames.seq, self.frames.frame, self.frames.timestamp
+
+    def run(self, host='0.0.0.0', port=5000):
+        """Serve forever (blocks)."""
+        asyncio.run(self.serve(host, port))
+
+    async def serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self.new_frame = asyncio.Event()
+        self.frames.listeners.append(self)
+        self.frames.start()
+        server = await asyncio.start_server(self.handle, host, port, limit=self.MAX_HEADER_BYTES)
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.HEADER_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            lines = head.decode('latin-1').split('\r\n')
+            try:
+                method, target, version = lines[0].split(' ', 2)
+            except ValueError:
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n')
+                return
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+            path, _, query = target.partition('?')
+            peer = writer.get_extra_info('peername') or ('', 0)
+
+            if method == 'GET' and path == '/video':
+                await self.stream_video(writer, query, peer[0])
+            else:
+                body = b''
+                length = int(headers.get('content-length') or 0)
+                if length:
+                    body = await reader.readexactly(length)
+                await self.call_wsgi(writer, method, path, query, version, headers, body, peer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Client went away or sent garbage
+        finally:
+            writer.close()
+
+    async def stream_video(self, writer, query, remote_addr):
+        """Same stream as gen_frames, but as a coroutine."""
+        profile = None
+        roi = False
+        for name, _, value in (part.partition('=') for part in query.split('&')):
+            if name == 'profile' and value.lstrip('-').isdigit():
+                profile = min(max(int(value), 0), len(STREAM_PROFILES) - 1)
+            elif name == 'roi':
+                roi = value in ('1', 'true', 'yes')
+        client = StreamClient(next(stream_client_ids), remote_addr, profile, roi)
+        governor.start()
+
+        # With no write buffer, drain() waits for the kernel to take the
+        # chunk, so the adaptive timing sees slow viewers like it does in
+        # threaded mode
+        writer.transport.set_write_buffer_limits(high=0)
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Connection: close\r\n\r\n')
+        await writer.drain()
+
+        with stream_clients_lock:
+            stream_clients[client.id] = client
+        try:
+            last_seq = 0
+            next_due = 0.0
+            while True:
+                width, height, quality, fps = client.profile()
+
+                # Don't send faster than this viewer's profile allows
+                wait = next_due - time.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                seq, frame, grabbed_at = await self.next_frame(last_seq)
+                if frame is None:
+                    continue  # Camera is down, keep waiting
+
+                crop = None
+                if client.roi:
+                    crop = await self.loop.run_in_executor(
+                        self.executor, roi_tracker.stream_crop, seq, frame, width, height)
+
+                # Another viewer may already have encoded this frame
+                cached = stream_encoder._cached(stream_encoder.key(width, height, quality, crop), seq)
+                if cached is None:
+                    cached = await self.loop.run_in_executor(
+                        self.executor, stream_encoder.get_chunk, seq, frame, width, height, quality, crop)
+                last_seq, chunk = cached
+                next_due = time.time() + 1.0 / fps
+
+                sent_at = time.time()
+                writer.write(chunk)
+                await writer.drain()
+                done_at = time.time()
+                client.record(len(chunk), done_at - sent_at, done_at - grabbed_at)
+        finally:
+            with stream_clients_lock:
+                stream_clients.pop(client.id, None)
+
+    async def call_wsgi(self, writer, method, path, query, version, headers, body, peer):
+        """Run one request through the Flask app on the worker pool."""
+        sockname = writer.get_extra_info('sockname') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': str(sockname[0]),
+            'SERVER_PORT': str(sockname[1]),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0],
+            'REMOTE_PORT': str(peer[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': SendfileWrapper,
+        }
+        for name, value in headers.items():
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        response = {}
+        early = []                   # Anything sent through the old-style write() callable
+        def start_response(status, response_headers, exc_info=None):
+            response['status'], response['headers'] = status, response_headers
+            return early.append
+
+        done = object()
+        result = await self.loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        try:
+            span = sendfile_span(result)
+            if span is not None:
+                # Photo files: let the kernel copy them straight to the socket
+                self.write_head(writer, response, early)
+                await writer.drain()
+                file, offset, count = span
+                await self.loop.sendfile(writer.transport, file, offset, count)
+                return
+
+            # Pull chunks on the pool too, so a streamed ZIP can't block the loop
+            chunks = iter(result)
+            chunk = await self.loop.run_in_executor(self.executor, next, chunks, done)
+            self.write_head(writer, response, early)
+            while chunk is not done:
+                writer.write(chunk)
+                await writer.drain()
+                chunk = await self.loop.run_in_executor(self.executor, next, chunks, done)
+        finally:
+            if hasattr(result, 'close'):
+                await self.loop.run_in_executor(self.executor, result.close)
+
+    def write_head(self, writer, response, early):
+        """Status line and headers of a WSGI response (we always close afterwards)."""
+        head = [f"HTTP/1.1 {response['status']}"]
+        head += [f"{name}: {value}" for name, value in response['headers']
+                 if name.lower() != 'connection']
+        head.append("Connection: close")
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        writer.write(b''.join(early))
 
 
 # ============================================================
@@ -819,9 +5069,23 @@ if __name__ == "__main__":
     print(f"📸 Auto-capture every {AUTO_CAPTURE_INTERVAL} seconds")
     print(f"🌐 Access at http://<pi-ip>:5000")
     
+    # Start reading the camera right away
+    broadcaster.start()
+    system_sampler.start()
+    governor.start()
+    pretrigger.start()
+    storage_tiers.start()
+    
+    # Fill in any thumbnails that are missing
+    thumbnails.backfill()
+    
     # Start the auto-capture background thread
     capture_thread = threading.Thread(target=periodic_capture, daemon=True)
     capture_thread.start()
     
     # Run the web server
-    app.run(host='0.0.0.0', port=5000, threaded=True)
+    if SERVER_MODE == "async":
+        print("⚡ Async server mode")
+        AsyncServer(app, broadcaster).run(host='0.0.0.0', port=5000)
+    else:
+        app.run(host='0.0.0.0', port=5000, threaded=True)
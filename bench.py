@@ -0,0 +1,265 @@
+"""
+WALDO benchmark - measure the camera server without a camera attached.
+
+Runs app.py in-process against the synthetic (or replay) camera backend
+in a throwaway folder, then hammers it the way a busy night would:
+N browsers on /video, someone clicking Capture and Burst, and the
+gallery being opened with 1k / 10k / 100k photos in the index.
+
+    python3 bench.py                          # 4 viewers, 20 seconds
+    python3 bench.py --clients 10 --duration 60
+    python3 bench.py --backend replay --replay-source ~/POLARIS/moon_shots
+    python3 bench.py --gallery-sizes 1000,10000 --output bench_output.txt
+    python3 bench.py --server async --clients 50  # SERVER_MODE = "async"
+
+Reports stream FPS per viewer, capture/burst latency percentiles, CPU
+time per camera frame and per streamed frame, and gallery latency.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile (None for an empty list)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    """p50 / p90 / p99 / max in milliseconds."""
+    if not values:
+        return "no samples"
+    return "p50 {:.1f} ms  p90 {:.1f} ms  p99 {:.1f} ms  max {:.1f} ms  (n={})".format(
+        percentile(values, 50) * 1000, percentile(values, 90) * 1000,
+        percentile(values, 99) * 1000, max(values) * 1000, len(values))
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+# ============================================================
+# LOAD GENERATORS
+# ============================================================
+
+def stream_viewer(port, stop, result):
+    """Read /video like a browser does and count the frames."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', '/video')
+    response = conn.getresponse()
+    frames, received = 0, 0
+    started = time.perf_counter()
+    buffer = b''
+    try:
+        while not stop.is_set():
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            received += len(chunk)
+            buffer += chunk
+            frames += buffer.count(b'--frame\r\n')
+            buffer = buffer[-16:]  # Keep enough to catch a boundary split across reads
+    finally:
+        elapsed = time.perf_counter() - started
+        conn.close()
+    result.update(frames=frames, bytes=received, seconds=elapsed)
+
+
+def capture_load(port, stop, interval, latencies, burst_latencies, burst_every):
+    """POST /capture every interval seconds, and /burst every burst_every captures."""
+    count = 0
+    while not stop.is_set():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        count += 1
+        if burst_every and count % burst_every == 0:
+            body = json.dumps({"count": 5, "delay": 0.2})
+            started = time.perf_counter()
+            conn.request('POST', '/burst', body, {'Content-Type': 'application/json'})
+            conn.getresponse().read()
+            burst_latencies.append(time.perf_counter() - started)
+        else:
+            started = time.perf_counter()
+            conn.request('POST', '/capture')
+            conn.getresponse().read()
+            latencies.append(time.perf_counter() - started)
+        conn.close()
+        stop.wait(interval)
+
+
+def fill_index(waldo, count):
+    """Put count fake photos in the index (rows only, no files) for gallery timing."""
+    waldo.photo_index.clear()
+    start = time.time() - count * 10
+    rows = [(f"auto_{i:07d}.jpg", "auto", start + i * 10, 250000, 1280, 720) for i in range(count)]
+    with waldo.photo_index.lock:
+        waldo.photo_index.db.executemany(
+            "INSERT INTO photos (filename, kind, timestamp, size, width, height) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        waldo.photo_index.db.commit()
+    waldo.photo_index._load_totals()
+
+
+def time_get(port, path, repeats):
+    latencies = []
+    for _ in range(repeats):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        started = time.perf_counter()
+        conn.request('GET', path)
+        conn.getresponse().read()
+        latencies.append(time.perf_counter() - started)
+        conn.close()
+    return latencies
+
+
+# ============================================================
+# MAIN
+# ============================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the WALDO camera server.")
+    parser.add_argument('--clients', type=int, default=4, help="Concurrent /video viewers")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds to run the stream + capture load")
+    parser.add_argument('--backend', choices=['synthetic', 'replay'], default='synthetic')
+    parser.add_argument('--replay-source', help="Folder of .jpg files or a video file (replay backend)")
+    parser.add_argument('--fps', type=float, default=30, help="Camera frame rate to simulate")
+    parser.add_argument('--passthrough', action='store_true',
+                        help="Camera hands out JPEG bytes (MJPEG_PASSTHROUGH). "
+                             "The fake camera's own JPEG encoding is counted in CPU.")
+    parser.add_argument('--server', choices=['threaded', 'async'], default='threaded',
+                        help="Serve like app.run(threaded=True) or with the AsyncServer")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--capture-interval', type=float, default=2.0, help="Seconds between /capture calls (0 = off)")
+    parser.add_argument('--burst-every', type=int, default=5, help="Every Nth capture is a 5-frame /burst (0 = never)")
+    parser.add_argument('--gallery-sizes', default="1000,10000,100000", help="Index sizes to time the gallery at")
+    parser.add_argument('--gallery-repeats', type=int, default=20)
+    parser.add_argument('--output', help="Also write the report to this file")
+    args = parser.parse_args()
+    if args.backend == 'replay' and not args.replay_source:
+        parser.error("--replay-source is needed for the replay backend")
+    # Resolve paths before we leave the current directory
+    replay_source = os.path.abspath(os.path.expanduser(args.replay_source)) if args.replay_source else None
+    output = os.path.abspath(args.output) if args.output else None
+
+    # app.py keeps everything relative to the working directory, so run it
+    # in a scratch folder that gets thrown away afterwards
+    workdir = tempfile.mkdtemp(prefix="waldo_bench_")
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    import app as waldo
+    from werkzeug.serving import make_server
+
+    waldo.app.root_path = workdir
+    waldo.CAMERA_BACKEND = args.backend
+    waldo.SYNTHETIC_FPS = args.fps
+    waldo.REPLAY_FPS = args.fps
+    waldo.MJPEG_PASSTHROUGH = args.passthrough
+    waldo.PHOTO_WIDTH, waldo.PHOTO_HEIGHT = args.width, args.height
+    if replay_source:
+        waldo.REPLAY_SOURCE = replay_source
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # No per-request log lines
+    if args.server == 'async':
+        server = None
+        async_server = waldo.AsyncServer(waldo.app, waldo.broadcaster)
+        threading.Thread(target=async_server.run, args=('127.0.0.1', 0), daemon=True).start()
+        async_server.ready.wait(10)
+        port = async_server.port
+    else:
+        server = make_server('127.0.0.1', 0, waldo.app, threaded=True)
+        port = server.server_port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Let the camera warm up before measuring
+    waldo.broadcaster.start()
+    waldo.read_frame()
+
+    report = [f"WALDO benchmark - {args.clients} viewers, {args.duration:.0f} s, "
+              f"{args.backend} camera at {args.width}x{args.height} @ {args.fps:g} FPS"
+              + (" (MJPEG passthrough)" if args.passthrough else "")
+              + (" (async server)" if args.server == 'async' else "")]
+
+    # --- Streaming + capture load ---
+    stop = threading.Event()
+    viewers = [{} for _ in range(args.clients)]
+    threads = [threading.Thread(target=stream_viewer, args=(port, stop, result), daemon=True)
+               for result in viewers]
+    capture_latencies, burst_latencies = [], []
+    if args.capture_interval > 0:
+        threads.append(threading.Thread(
+            target=capture_load,
+            args=(port, stop, args.capture_interval, capture_latencies, burst_latencies, args.burst_every),
+            daemon=True))
+
+    seq_before = waldo.broadcaster.latest_seq()
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    server_threads = threading.active_count() - len(threads)  # Minus our own load generators
+    stop.set()
+    for t in threads:
+        t.join(timeout=35)
+    elapsed = time.perf_counter() - started
+    cpu_used = cpu_seconds() - cpu_before
+    camera_frames = waldo.broadcaster.latest_seq() - seq_before
+    waldo.disk_writer.flush()
+
+    streamed = sum(v.get('frames', 0) for v in viewers)
+    report.append("")
+    report.append("Stream")
+    for i, v in enumerate(viewers, 1):
+        fps = v.get('frames', 0) / v['seconds'] if v.get('seconds') else 0
+        report.append(f"  viewer {i}: {fps:5.1f} FPS, {v.get('bytes', 0) / 1024 / max(elapsed, 1e-9):7.1f} KB/s")
+    report.append(f"  camera: {camera_frames / elapsed:5.1f} FPS read")
+    report.append(f"  threads: {server_threads} in the server process under load")
+    encoder = waldo.stream_encoder.stats()
+    report.append(f"  encoder: {encoder['encodes']} encodes, {encoder['cache_hits']} cache hits")
+    report.append("")
+    report.append("CPU (whole process)")
+    report.append(f"  {cpu_used / elapsed * 100:5.1f}% of one core")
+    if camera_frames:
+        report.append(f"  {cpu_used / camera_frames * 1000:6.2f} ms per camera frame")
+    if streamed:
+        report.append(f"  {cpu_used / streamed * 1000:6.2f} ms per streamed frame")
+    report.append("")
+    report.append("Capture latency")
+    report.append(f"  /capture: {summarize(capture_latencies)}")
+    report.append(f"  /burst:   {summarize(burst_latencies)}")
+
+    # --- Gallery at different sizes ---
+    report.append("")
+    report.append("Gallery latency")
+    for size in [int(s) for s in args.gallery_sizes.split(',') if s.strip()]:
+        fill_index(waldo, size)
+        gallery = time_get(port, '/gallery', args.gallery_repeats)
+        api = time_get(port, '/api/photos?limit=48', args.gallery_repeats)
+        report.append(f"  {size:>7} photos  /gallery     {summarize(gallery)}")
+        report.append(f"  {size:>7} photos  /api/photos  {summarize(api)}")
+
+    if server is not None:
+        server.shutdown()
+    text = "\n".join(report)
+    print(text)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# app.py makes its photo folder and index in the working directory when
+# it's imported, so import it from a scratch folder instead of the repo
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="polaris-tests-"))
@@ -0,0 +1,114 @@
+"""The camera supervisor in FrameBroadcaster, driven by CameraFaults."""
+
+import time
+
+import pytest
+
+import app
+
+
+class RecordingBroadcaster(app.FrameBroadcaster):
+    """Remembers every state it went through and whether each frame was stale."""
+
+    def __init__(self, opener):
+        super().__init__(opener=opener)
+        self.states = []
+        self.stale_flags = []
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.states.append(state)
+        super()._set_state(state)
+
+    def publish(self, frame, now=None):
+        self.stale_flags.append(frame.stale)
+        super().publish(frame, now)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+@pytest.fixture(autouse=True)
+def fast_supervisor(monkeypatch):
+    monkeypatch.setattr(app, "CAMERA_BACKOFF_START", 0.01)
+    monkeypatch.setattr(app, "CAMERA_BACKOFF_MAX", 0.04)
+    monkeypatch.setattr(app, "CAMERA_WARMUP_FRAMES", 2)
+    monkeypatch.setattr(app, "CAMERA_STALE_INTERVAL", 0.005)
+    monkeypatch.setattr(app, "CAMERA_FAIL_THRESHOLD", 3)
+
+
+def run(faults):
+    opener = lambda: app.FaultyCamera(app.SyntheticCamera(64, 48, 500), faults)
+    broadcaster = RecordingBroadcaster(opener)
+    broadcaster.start()
+    return broadcaster
+
+
+def test_outage_goes_through_every_state_and_recovers():
+    # One outage just long enough to give up on the handle, then one failed reopen
+    faults = app.CameraFaults(fail_after=20, outage=3, open_failures=1)
+    broadcaster = run(faults)
+    try:
+        assert wait_until(lambda: broadcaster.states.count("healthy") >= 2)
+    finally:
+        broadcaster.stop()
+    assert broadcaster.states == ["warming_up", "healthy", "degraded", "reconnecting",
+                                  "warming_up", "healthy"]
+    assert broadcaster.reconnects == 1
+    assert broadcaster.open_failures == 1
+    assert broadcaster.warmup_discarded >= 2 * app.CAMERA_WARMUP_FRAMES
+    assert broadcaster.backoff == app.CAMERA_BACKOFF_START  # Reset once it warmed up again
+
+
+def test_outage_frames_are_flagged_stale():
+    faults = app.CameraFaults(fail_after=20, outage=3, open_failures=2)
+    broadcaster = run(faults)
+    try:
+        assert wait_until(lambda: broadcaster.states.count("healthy") >= 2)
+    finally:
+        broadcaster.stop()
+    flags = broadcaster.stale_flags
+    assert True in flags
+    first_stale = flags.index(True)
+    last_stale = len(flags) - 1 - flags[::-1].index(True)
+    # Real frames before the outage, only stale ones during it, real ones after
+    assert not any(flags[:first_stale])
+    assert all(flags[first_stale:last_stale + 1])
+    assert last_stale < len(flags) - 1
+
+
+def test_backoff_is_capped_while_the_camera_wont_open():
+    broadcaster = RecordingBroadcaster(lambda: None)
+    broadcaster.start()
+    try:
+        assert wait_until(lambda: broadcaster.open_failures >= 6)
+    finally:
+        broadcaster.stop()
+    assert broadcaster.state == "reconnecting"
+    assert broadcaster.backoff == app.CAMERA_BACKOFF_MAX
+
+
+def test_backoff_keeps_growing_when_reads_fail_before_warm_up():
+    # Opens fine, then every read fails: never warms up, so the backoff never resets
+    faults = app.CameraFaults(fail_after=0, outage=10 ** 9)
+    broadcaster = run(faults)
+    try:
+        assert wait_until(lambda: broadcaster.reconnects >= 4)
+    finally:
+        broadcaster.stop()
+    assert "healthy" not in broadcaster.states
+    assert broadcaster.backoff == app.CAMERA_BACKOFF_MAX
+
+
+def test_stop_releases_the_camera():
+    broadcaster = run(app.CameraFaults())
+    assert wait_until(lambda: broadcaster.state == "healthy")
+    broadcaster.stop()
+    assert not broadcaster.thread.is_alive()
+    assert broadcaster.camera is None
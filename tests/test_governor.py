@@ -0,0 +1,118 @@
+"""PerformanceGovernor tiers, hysteresis and encode slots, with fake readings."""
+
+import threading
+
+import pytest
+
+import app
+
+
+class Readings:
+    def __init__(self, temp=50.0, load=0.1):
+        self.temp = temp
+        self.load = load
+
+
+@pytest.fixture
+def readings():
+    return Readings()
+
+
+@pytest.fixture
+def governor(readings, monkeypatch):
+    monkeypatch.setattr(app, "GOVERNOR_ENABLED", True)
+    monkeypatch.setattr(app, "GOVERNOR_RECOVER_SECONDS", 30)
+    monkeypatch.setattr(app, "GOVERNOR_HYSTERESIS_C", 5)
+    return app.PerformanceGovernor(temp_source=lambda: readings.temp, load_source=lambda: readings.load)
+
+
+def tier(name):
+    return [t[0] for t in app.GOVERNOR_TIERS].index(name)
+
+
+def test_jumps_straight_to_the_hottest_tier_reached(governor, readings):
+    assert governor.check(now=0) == tier("normal")
+    readings.temp = 73
+    assert governor.check(now=2) == tier("hot")
+    readings.load = 3.0
+    assert governor.check(now=4) == tier("critical")
+    assert [t["to"] for t in governor.transitions] == ["hot", "critical"]
+
+
+def test_steps_back_one_tier_after_staying_cool(governor, readings):
+    readings.temp = 73
+    governor.check(now=0)
+    # Below the hot limit but not by the hysteresis margin: stays hot
+    readings.temp = 70
+    assert governor.check(now=10) == tier("hot")
+    assert governor.check(now=100) == tier("hot")
+    # Comfortably cool, but not for GOVERNOR_RECOVER_SECONDS yet
+    readings.temp = 50
+    assert governor.check(now=110) == tier("hot")
+    assert governor.check(now=139) == tier("hot")
+    assert governor.check(now=140) == tier("warm")
+    # The cool timer starts over in every tier
+    assert governor.check(now=141) == tier("warm")
+    assert governor.check(now=171) == tier("normal")
+    assert [t["reason"] for t in governor.transitions][-2:] == ["recovered", "recovered"]
+
+
+def test_warming_up_again_resets_the_cool_timer(governor, readings):
+    readings.temp = 73
+    governor.check(now=0)
+    readings.temp = 50
+    governor.check(now=10)
+    readings.temp = 69              # Not cool enough any more
+    governor.check(now=20)
+    readings.temp = 50
+    assert governor.check(now=45) == tier("hot")   # 40 s since first cool, but the timer restarted
+    assert governor.check(now=75) == tier("warm")
+
+
+def hold_slot(governor, entered, release):
+    with governor.encode_slot():
+        entered.set()
+        release.wait(5)
+
+
+def test_encode_slots_follow_the_tier(governor, readings):
+    readings.temp = 73
+    governor.check(now=0)
+    assert app.GOVERNOR_TIERS[governor.tier][6] == 1
+    first_in, first_out = threading.Event(), threading.Event()
+    second_in, second_out = threading.Event(), threading.Event()
+    first = threading.Thread(target=hold_slot, args=(governor, first_in, first_out))
+    second = threading.Thread(target=hold_slot, args=(governor, second_in, second_out))
+    first.start()
+    assert first_in.wait(2)
+    second.start()
+    assert not second_in.wait(0.2)  # Only one encode at a time when hot
+    assert governor.encoding == 1
+
+    # Dropping to a tier without a limit lets the waiting encode straight in
+    governor.force(tier("normal"))
+    assert second_in.wait(2)
+    assert governor.encoding == 2
+    first_out.set()
+    second_out.set()
+    first.join(2)
+    second.join(2)
+    assert governor.encoding == 0
+
+
+def test_waiting_encode_gets_the_slot_when_it_frees_up(governor, readings):
+    governor.force(tier("critical"))
+    first_in, first_out = threading.Event(), threading.Event()
+    second_in, second_out = threading.Event(), threading.Event()
+    first = threading.Thread(target=hold_slot, args=(governor, first_in, first_out))
+    second = threading.Thread(target=hold_slot, args=(governor, second_in, second_out))
+    first.start()
+    assert first_in.wait(2)
+    second.start()
+    assert not second_in.wait(0.2)
+    first_out.set()
+    assert second_in.wait(2)
+    second_out.set()
+    first.join(2)
+    second.join(2)
+    assert governor.encoding == 0